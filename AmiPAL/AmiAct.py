@@ -0,0 +1,348 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Actions
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import os
+from collections import OrderedDict, deque
+from itertools import count
+from time import time
+
+
+class AmiError(Exception):
+    """
+    AMI responded with an error.
+    """
+    def __init__(self, message, event=None):
+        super(AmiError, self).__init__(message)
+        self.event = event
+
+
+class AmiTimeout(AmiError):
+    """
+    AMI did not respond in time.
+    """
+
+
+class ActionID(object):
+    """
+    ActionID allocator.
+    """
+    # Connection sequence number within the process
+    _conn = count(1)
+
+    def __init__(self, prefix=None, size=10000):
+        """
+        Allocate unique, monotonic ActionIDs: connection prefix + counter.
+        Send time of every ID is remembered (up to 'size' IDs) to measure round-trip latency.
+        """
+        if prefix is None:
+            prefix = "%x.%x.%d." % (os.getpid(), int(time()), next(self._conn))
+        self.prefix = str(prefix)
+        self.size = int(size)
+        self.sent = OrderedDict()           # ActionID -> send timestamp
+        self.rtt = deque(maxlen=self.size)  # Latest round-trip times (seconds)
+        self._count = count(1)
+
+    def new(self):
+        """
+        Return new ActionID and remember when it was allocated.
+        """
+        aid = self.prefix + str(next(self._count))
+        sent = self.sent
+        sent[aid] = time()
+        if len(sent) > self.size:
+            sent.popitem(last=False)
+        return aid
+
+    def done(self, aid):
+        """
+        Mark ActionID as answered, return its round-trip time or None if unknown.
+        """
+        sent = self.sent.pop(aid, None)
+        if sent is None:
+            return None
+        rtt = time() - sent
+        self.rtt.append(rtt)
+        return rtt
+
+
+class AmiAction(object):
+    """
+    AMI command (Action) specification.
+    """
+    __slots__ = ("name", "required", "optional", "listing", "doc", "_head", "_keys")
+
+    nl = "\r\n"        # New line terminator
+
+    def __init__(self, name, required=(), optional=(), listing=False, doc=None):
+        """
+        Precompile command template, so serializing the command costs a single join.
+        - required, optional: Argument (header) names.
+        - listing: Command responds with the list of events.
+        """
+        nl = self.nl
+        self.name = str(name)
+        self.required = tuple(required)
+        self.optional = tuple(optional)
+        self.listing = bool(listing)
+        self.doc = doc
+        self._head = "Action: %s%sActionID: " % (self.name, nl)
+        self._keys = { k: "%s%s: " % (nl, k) for k in self.required + self.optional }
+
+    def args(self, a, kw):
+        """
+        Extract command arguments from positional (required args only) or keyword input.
+        Return None if both are mixed.
+        """
+        required = self.required
+        # If there are required args and none are supplied via 'a' or 'kw'
+        if required and not (a or kw):
+            raise ValueError("Err :-: Please supply all required arguments: (%s)" % ', '.join(required))
+        if a and kw: return  # disallow argument mixing
+        if a:
+            if not required: return {}
+            if len(a) != len(required):
+                raise ValueError("Err :-: Please supply all required arguments: (%s)" % ', '.join(required))
+            return { k: v for k, v in zip(required, a) if v }
+        for k in required:
+            if k not in kw:
+                raise ValueError("Err :-: Please supply all required arguments: (%s)" % ', '.join(required))
+        return { k: kw[k] for k in self._keys if kw.get(k) }
+
+    def serialize(self, aid, args=None):
+        """
+        Return AMI command string. List (or tuple) value repeats the header (eg. 'Variable').
+        """
+        nl = self.nl
+        parts = [self._head, aid]
+        if args:
+            keys = self._keys
+            for k, v in args.iteritems():
+                head = keys.get(k) or "%s%s: " % (nl, k)
+                if isinstance(v, (list, tuple)):
+                    for x in v:
+                        parts.append(head)
+                        parts.append(str(x))
+                else:
+                    parts.append(head)
+                    parts.append(str(v))
+        # Double nl at the end is required to submit AMI command
+        parts.append(nl * 2)
+        return "".join(parts)
+
+
+# AMI built-in Commands (Actions) table. AmiCmd gets a method for every entry.
+ACTIONS = (
+    AmiAction("Ping",
+              doc="""
+              A 'Ping' action will ellicit a 'Pong' response.
+              Used to keep the manager connection open."""),
+    AmiAction("ListCommands",
+              doc="""
+              Returns the action name and synopsis for every action that is
+              available to the user."""),
+    AmiAction("SIPshowregistry",
+              listing=True,
+              doc="""
+              Show SIP registrations (text format)."""),
+    AmiAction("SIPpeers",
+              listing=True,
+              doc="""
+              Lists SIP peers in text format with details on current status."""),
+    AmiAction("SIPshowpeer",
+              required=['Peer'],
+              doc="""
+              Show one SIP peer with details on current status.
+              Required args:
+                  - Peer: The peer name you want to check."""),
+    AmiAction("SIPqualifypeer",
+              required=['Peer'],
+              doc="""
+              Qualify a SIP peer.
+              # Required args:
+                  - Peer: The peer name you want to qualify."""),
+    AmiAction("ShowDialPlan",
+              optional=['Extension', 'Context'],
+              listing=True,
+              doc="""
+              Show dialplan contexts and extensions. Be aware that showing the full
+              dialplan may take a lot of capacity.
+              # Optional args:
+                  - Extension: Show a specific extension.
+                  - Context: Show a specific context."""),
+    AmiAction("Originate",
+              required=['Channel'],
+              optional=['Exten', 'Context', 'Priority', 'Application', 'Data', 'Timeout',
+                        'CallerID', 'Variable', 'Account', 'Async', 'Codecs'],
+              doc="""
+              Generates an outgoing call to a <Extension>/<Context>/<Priority> or
+              <Application>/<Data>.
+              # Required args:
+                  - Channel: Channel name to call.
+
+              # Optional args:
+                  - Exten: Extension to use (requires 'Context' and 'Priority')
+                  - Context: Context to use (requires 'Exten' and 'Priority')
+                  - Priority: Priority to use (requires 'Exten' and 'Context')
+                  - Application: Application to execute.
+                  - Data: Data to use (requires 'Application').
+                  - Timeout: How long to wait for call to be answered (in ms.).
+                  - CallerID: Caller ID to be set on the outgoing channel.
+                  - Variable: Channel variable to set, multiple Variable: headers are allowed
+                              (pass them as a list).
+                  - Account: Account code.
+                  - Async: Set to 'true' for fast origination.
+                  - Codecs: Comma-separated list of codecs to use for this call.
+
+              e.g. dict(Channel="SIP/965", Exten="965", Context="default",
+                        Priority="1", CallerID="666", Timeout="10000", Async="Yes")
+                   dict(Channel="SIP/965", CallerID="666", Timeout="10000", Async="Yes")"""),
+    AmiAction("Hangup",
+              required=['Channel'],
+              optional=['Cause'],
+              doc="""
+              Hangup channel.
+              # Required args:
+                  - Channel: Channel name to be hangup.
+
+              # Optional args:
+                  - Cause: Numeric hangup cause."""),
+    AmiAction("Redirect",
+              required=['Channel', 'Exten', 'Context', 'Priority'],
+              optional=['ExtraChannel', 'ExtraExten', 'ExtraContext', 'ExtraPriority'],
+              doc="""
+              Redirect (transfer) a call.
+              # Required args:
+                  - Channel: Channel to redirect.
+                  - Exten: Extension to transfer to.
+                  - Context: Context to transfer to.
+                  - Priority: Priority to transfer to.
+
+              # Optional args:
+                  - ExtraChannel: Second call leg to transfer (optional).
+                  - ExtraExten: Extension to transfer extrachannel to (optional).
+                  - ExtraContext: Context to transfer extrachannel to (optional).
+                  - ExtraPriority: Priority to transfer extrachannel to (optional)."""),
+    AmiAction("Atxfer",
+              required=['Channel', 'Exten', 'Context', 'Priority'],
+              doc="""
+              Attended transfer.
+              # Required args:
+                  - Channel: Transferer's channel.
+                  - Exten: Extension to transfer to.
+                  - Context: Context to transfer to.
+                  - Priority: Priority to transfer to."""),
+    AmiAction("PlayDTMF",
+              required=['Channel', 'Digit'],
+              doc="""
+              Play DTMF digit (signal) on a specific channel.
+              # Required args:
+                  - Channel: Channel name to send digit to.
+                  - Digit: The DTMF digit to play."""),
+    AmiAction("Bridge",
+              required=['Channel1', 'Channel2'],
+              optional=['Tone'],
+              doc="""
+              Bridge together two channels already in the PBX.
+              # Required args:
+                  - Channel1: Channel to Bridge to Channel2.
+                  - Channel2: Channel to Bridge to Channel1.
+
+              # Optional args:
+                  - Tone: Play courtesy tone to Channel2 (yes/no)."""),
+    AmiAction("Park",
+              required=['Channel', 'Channel2'],
+              optional=['Timeout', 'Parkinglot'],
+              doc="""
+              Park a channel.
+              # Required args:
+                  - Channel: Channel name to park.
+                  - Channel2: Channel to return to if timeout.
+
+              # Optional args:
+                  - Timeout: Number of milliseconds to wait before callback.
+                  - Parkinglot: Specify in which parking lot to park the channel."""),
+    AmiAction("ParkedCalls",
+              listing=True,
+              doc="""
+              List parked calls."""),
+    AmiAction("Queues",
+              doc="""
+              Show queues information. Check the log for the output"""),
+    AmiAction("Agents",
+              listing=True,
+              doc="""
+              Will list info about all possible agents."""),
+    AmiAction("CoreShowChannels",
+              listing=True,
+              doc="""
+              List currently defined channels and some information about them."""),
+    AmiAction("CoreStatus",
+              doc="""
+              Show PBX core status variables."""),
+    AmiAction("CoreSettings",
+              doc="""
+              Show PBX core settings (version etc)."""),
+    AmiAction("Status",
+              optional=['Channel', 'Variables'],
+              listing=True,
+              doc="""
+              Will return the status information of each channel along with the
+              value for the specified channel variables.
+              # Optional args:
+                  - Channel: The name of the channel to query for status.
+                  - Variables: Comma ',' separated list of variable to include."""),
+    AmiAction("GetConfig",
+              required=['Filename'],
+              optional=['Category'],
+              doc="""
+              This action will dump the contents of a configuration file by category
+              and contents or optionally by specified category only.
+              # Required args:
+                  - Filename: Configuration filename (e.g. "foo.conf").
+
+              # Optional args:
+                  - Category: Category in configuration file."""),
+    AmiAction("GetConfigJSON",
+              required=['Filename'],
+              doc="""
+              This action will dump the contents of a configuration file by category
+              and contents in JSON format. This only makes sense to be used using rawman
+              over the HTTP interface.
+              # Required args:
+                  - Filename: Configuration filename (e.g. "foo.conf")."""),
+)
+
+# End event headers of the commands that return list
+EVEND = frozenset(["RegistrationsComplete", "PeerlistComplete",
+                   "ParkedCallsComplete", "AgentsComplete",
+                   "StatusComplete", "ShowDialPlanComplete",
+                   "CoreShowChannelsComplete"])
@@ -0,0 +1,342 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Controller (asyncio)
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import logging, random
+from collections import OrderedDict
+from time import time
+
+# asyncio for Python 2 (no interpreter patching, unlike the gevent based AmiCtl)
+import trollius as asyncio
+from trollius import From, Return
+
+# Main Ami event registry class, event handler registry
+from AmiReg import AmiReg, AmiHandlers
+# Command (Action) templates, built-in Commands table
+from AmiAct import ActionID, AmiAction, AmiError, AmiTimeout, ACTIONS, EVEND
+
+
+LOG_NAME = "AmiPAL"
+
+
+class AmiFuture(asyncio.Future):
+    """
+    Future result of the AMI command (Action), see AmiResult.
+    """
+    def __init__(self, cid=None, loop=None):
+        super(AmiFuture, self).__init__(loop=loop)
+        # Command ID (ActionID)
+        self.cid = cid
+        # Round-trip time (seconds), set when AMI responds
+        self.rtt = None
+
+
+class AmiAio(object):
+    """
+    Ami Controller and built-in Commands (asyncio).
+    """
+    nl = "\r\n"        # New line terminator
+    buff = 65536       # StreamReader read size
+    ttl = 60           # Seconds to wait for the response
+    reconnect = True   # Reconnect (with backoff) and log in again when connection drops
+    retry_base = .5    # Reconnect backoff: first delay and upper limit (seconds)
+    retry_max = 30.
+    # Action name -> AmiAction, methods are generated from the ACTIONS table
+    _actions = { x.name: x for x in ACTIONS }
+    # End event headers of the commands that return list
+    _evend = EVEND
+
+    def __init__(self, usr="ami", pwd="secret", host="127.0.0.1", port=5038, loop=None, **kw):
+        """
+        Same command surface as AmiCmd, but every command returns AmiFuture
+        (yield From(...) / await it) and I/O runs on the asyncio StreamReader / StreamWriter.
+        Run login() coroutine to connect and serve the connection.
+        """
+        self.usr = str(usr)
+        self.pwd = str(pwd)
+        self.host = str(host)
+        self.port = int(port)
+        self.loop = loop or asyncio.get_event_loop()
+        if kw.get("reconnect") is not None:
+            self.reconnect = bool(kw.get("reconnect"))
+        self.ttl = float(kw.get("ttl") or self.ttl)
+        self.log = logging.getLogger(LOG_NAME)
+        # Event handlers (see on)
+        self.handlers = AmiHandlers()
+        # Stream to python object parser, events nobody subscribed to are not parsed,
+        # unless reactor is overridden
+        want = self.handlers.wanted if getattr(self.reactor, "dispatching", False) else None
+        self.parser = AmiReg(want=want)
+        # ActionID allocator
+        self.ids = ActionID()
+        # Commands waiting for response: Command ID -> (AmiFuture, rows or None, timer)
+        self._pending = OrderedDict()
+        self._reader, self._writer = None, None
+        self._supervise = False
+        self.connected = False
+        self.reconnects = 0       # Successful reconnects
+        self.downtime = 0.        # Total seconds spent disconnected (after the first login)
+        self.down_since = None
+
+    def on(self, event, callback, **headers):
+        """
+        Subscribe callback to the event name (AmiHandlers.ANY for all), see AmiHandlers.on.
+        Return the subscription token for 'off'.
+        """
+        return self.handlers.on(event, callback, **headers)
+
+    def on_action(self, aid, callback, **headers):
+        """
+        Subscribe callback to the events carrying ActionID 'aid'.
+        """
+        return self.handlers.on_action(aid, callback, **headers)
+
+    def off(self, token):
+        """
+        Cancel the subscription.
+        """
+        return self.handlers.off(token)
+
+    ## - Connection - ##
+    def backoff(self, attempt):
+        """
+        Delay (seconds) before the reconnect 'attempt' (0 based), see AmiSocket.backoff.
+        """
+        delay = min(self.retry_base * 2 ** min(attempt, 32), self.retry_max)
+        return random.uniform(delay / 2, delay)
+
+    @asyncio.coroutine
+    def connect(self):
+        self.log.warning("Connecting to Asterisk manager: %s:%s", self.host, self.port)
+        self._reader, self._writer = yield From(asyncio.open_connection(self.host, self.port, loop=self.loop))
+        self.parser.buff.clear()
+        self.connected = True
+        self.log.warning("Connected.")
+
+    @asyncio.coroutine
+    def login(self):
+        """
+        Log in to the server and serve the connection (coroutine, returns on logoff).
+        When the connection drops, reconnect with jittered exponential backoff
+        and log in again, unless reconnect is disabled.
+        """
+        self._supervise = True
+        attempt = 0
+        while self._supervise:
+            try:
+                yield From(self.connect())
+            except (IOError, OSError) as e:
+                self.log.warning("Connection failed:\n%s", e)
+                if not self.reconnect:
+                    raise
+                yield From(asyncio.sleep(self.backoff(attempt), loop=self.loop))
+                attempt += 1
+                continue
+            if not self._supervise:
+                # Logged off while connecting
+                self.close()
+                break
+            attempt = 0
+            self.cmd("Login", Username=self.usr, Secret=self.pwd)
+            if self.down_since is not None:
+                self.downtime += time() - self.down_since
+                self.down_since = None
+                self.reconnects += 1
+            yield From(self._serve())
+            self._fail(AmiError("Connection lost"))
+            if not (self._supervise and self.reconnect):
+                break
+            self.down_since = time()
+
+    @asyncio.coroutine
+    def _serve(self):
+        """
+        Read from the connection and react, until it's closed.
+        """
+        reader = self._reader
+        try:
+            while True:
+                data = yield From(reader.read(self.buff))
+                if not data:
+                    break
+                self.reactor(data)
+        except (IOError, OSError) as e:
+            self.log.warning("Connection lost:\n%s", e)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.connected:
+            self.log.warning("Terminating connection: %s:%s", self.host, self.port)
+            self._writer.close()
+            self._reader, self._writer = None, None
+            self.connected = False
+
+    def logoff(self):
+        """
+        Log off from the server.
+        """
+        self._supervise = False
+        if self.connected:
+            self.cmd("Logoff")
+            self.close()
+
+    @property
+    def conn_stats(self):
+        down = time() - self.down_since if self.down_since is not None else 0.
+        return dict(connected=self.connected, reconnects=self.reconnects,
+                    downtime=self.downtime + down, down_for=down, pending=len(self._pending))
+
+    ## - Commands - ##
+    def _send(self, command):
+        if not self.connected:
+            raise IOError("<cmd> Err: Socket is dead!")
+        # Transport buffers the writes, so commands sent together leave in a single write
+        self._writer.write(command)
+
+    def cmd(self, action=None, **kw):
+        """
+        Send AMI command to the server, return its ActionID.
+        """
+        if not action or not isinstance(action, str):
+            raise ValueError("<_build_command> Err: Action must be 'str' type")
+        spec = self._actions.get(action) or AmiAction(action)
+        aid = self.ids.new()
+        self._send(spec.serialize(aid, kw))
+        return aid
+
+    def _call(self, spec, a, kw):
+        """
+        Validate input and send the command described by AmiAction spec.
+        Keyword 'ttl' sets the response deadline (seconds) of this very command.
+        """
+        ttl = kw.pop("ttl", None)
+        args = spec.args(a, kw)
+        if args is None or not self.connected:
+            return
+        return self._request(spec, args, ttl=ttl)
+
+    def _request(self, spec, args=None, ttl=None):
+        """
+        Send command and register its AmiFuture.
+        """
+        # Send command to AMI and capture request id
+        cid = self.ids.new()
+        self._send(spec.serialize(cid, args))
+        future = AmiFuture(cid, loop=self.loop)
+        timer = self.loop.call_later(self.ttl if ttl is None else ttl, self._expire, cid)
+        self._pending[cid] = (future, [] if spec.listing else None, timer)
+        return future
+
+    def _done(self, cid):
+        """
+        Stop tracking the command, return its AmiFuture or None if nobody waits for it.
+        """
+        future, rows, timer = self._pending.pop(cid)
+        timer.cancel()
+        future.rtt = self.ids.done(cid)
+        return None if future.done() else future
+
+    def _expire(self, cid):
+        if cid in self._pending:
+            future = self._done(cid)
+            if future is not None:
+                future.set_exception(AmiTimeout("No response for command: %s" % cid))
+
+    def _fail(self, exception):
+        for cid in list(self._pending):
+            future = self._done(cid)
+            if future is not None:
+                future.set_exception(exception)
+
+    def reactor(self, recv):
+        """
+        React, when data is received.
+        """
+        pending = self._pending
+        evend = self._evend
+        dispatch = self.handlers.dispatch
+        # Feed data to parser
+        self.parser.feed(recv)
+        for event in self.parser.events:
+            dispatch(event)
+            # Command ID
+            cid = event.get("ActionID")
+            entry = pending.get(cid)
+            if entry is None:
+                continue
+            response = event.get("Response")
+            rows = entry[1]
+            if response == "Error":
+                future = self._done(cid)
+                if future is not None:
+                    future.set_exception(AmiError(event.get("Message"), event))
+            elif rows is not None:
+                if event.get("Event") in evend:
+                    future = self._done(cid)
+                    if future is not None:
+                        future.set_result(rows)
+                elif not response:
+                    rows.append(event)
+            elif response:
+                future = self._done(cid)
+                if future is not None:
+                    future.set_result(event)
+    reactor.dispatching = True
+
+    @asyncio.coroutine
+    def Context(self, *a, **kw):
+        """
+        Custom method (coroutine). List unique dialplan contexts.
+        # Optional args:
+            - Extension: Show a specific extension.
+        """
+        result = self.ShowDialPlan(*a, **kw)
+        if result is None:
+            raise Return(None)
+        rows = yield From(result)
+        raise Return(sorted({x.get('Context') for x in rows if x.get('Context')}))
+
+
+
+def _action(spec):
+    """
+    Create AmiAio method sending the command described by AmiAction spec.
+    """
+    def action(self, *a, **kw):
+        return self._call(spec, a, kw)
+    action.__name__ = spec.name
+    action.__doc__ = spec.doc
+    return action
+
+for _spec in ACTIONS:
+    setattr(AmiAio, _spec.name, _action(_spec))
+del _spec
@@ -0,0 +1,279 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Parser Benchmark
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import json, os, resource, random, time, traceback
+
+# Main Ami event registry class
+from AmiReg import AmiReg
+
+
+# Default event mix (name -> relative weight)
+MIX = dict(Newchannel=10, VarSet=60, Hangup=10, ShowDialPlan=1, Status=19)
+# Default recv chunk sizes, small ones split lines and terminators
+CHUNKS = (7, 113, 1024, 4096, 65536)
+
+
+class AmiGen(object):
+    """
+    Synthetic Ami stream generator.
+    """
+    nl = "\r\n"        # New line terminator
+    banner = "Asterisk Call Manager/1.1"
+
+    def __init__(self, mix=None, seed=0, dialplan=200, variables=8):
+        """
+        Generate realistic Ami text streams.
+        - mix: Event name -> relative weight dict (see MIX).
+        - seed: Random seed, same seed produces the same stream.
+        - dialplan: Number of ListDialplan rows in every ShowDialPlan response.
+        - variables: Number of 'Variable' headers in every Status event.
+        """
+        self.mix = dict(mix or MIX)
+        self.rnd = random.Random(seed)
+        self.dialplan = int(dialplan)
+        self.variables = int(variables)
+        self._seq = 0
+
+    def _chunk(self, *lines):
+        """
+        Join (attribute, value) pairs into a terminated Ami chunk.
+        """
+        nl = self.nl
+        return nl.join("%s: %s" % line for line in lines) + nl * 2
+
+    def _channel(self):
+        self._seq += 1
+        return ("SIP/%d-%08x" % (self.rnd.randint(100, 999), self._seq),
+                "1452899%03d.%d" % (self.rnd.randint(0, 999), self._seq))
+
+    def Newchannel(self):
+        channel, uid = self._channel()
+        num = channel[4:7]
+        return self._chunk(("Event", "Newchannel"), ("Privilege", "call,all"),
+                           ("Channel", channel), ("ChannelState", "0"),
+                           ("ChannelStateDesc", "Down"), ("CallerIDNum", num),
+                           ("CallerIDName", "Ext %s" % num), ("AccountCode", ""),
+                           ("Exten", "965"), ("Context", "default"), ("Uniqueid", uid))
+
+    def VarSet(self):
+        channel, uid = self._channel()
+        return self._chunk(("Event", "VarSet"), ("Privilege", "dialplan,all"),
+                           ("Channel", channel), ("Variable", "RTPAUDIOQOS"),
+                           ("Value", "ssrc=%d;themssrc=%d;lp=0;rxjitter=0.000000;rxcount=%d"
+                                     % (self.rnd.getrandbits(31), self.rnd.getrandbits(31),
+                                        self.rnd.randint(0, 5000))),
+                           ("Uniqueid", uid))
+
+    def Hangup(self):
+        channel, uid = self._channel()
+        num = channel[4:7]
+        return self._chunk(("Event", "Hangup"), ("Privilege", "call,all"),
+                           ("Channel", channel), ("Uniqueid", uid),
+                           ("CallerIDNum", num), ("CallerIDName", "Ext %s" % num),
+                           ("Cause", "16"), ("Cause-txt", "Normal Clearing"))
+
+    def Status(self):
+        channel, uid = self._channel()
+        lines = [("Event", "Status"), ("Privilege", "Call"), ("Channel", channel),
+                 ("CallerIDNum", channel[4:7]), ("State", "Up"), ("Uniqueid", uid)]
+        lines.extend(("Variable", "VAR%d=%d" % (i, self.rnd.randint(0, 99999)))
+                     for i in range(self.variables))
+        return self._chunk(*lines)
+
+    def ShowDialPlan(self):
+        self._seq += 1
+        aid = "bench-%d" % self._seq
+        chunks = [self._chunk(("Response", "Success"), ("ActionID", aid),
+                              ("EventList", "start"), ("Message", "DialPlan list will follow"))]
+        for i in range(self.dialplan):
+            chunks.append(self._chunk(("Event", "ListDialplan"), ("ActionID", aid),
+                                      ("Context", "ctx-%d" % (i // 20)),
+                                      ("Extension", str(100 + i % 20)), ("Priority", "1"),
+                                      ("Application", "Dial"), ("AppData", "SIP/%d,30" % (100 + i % 20)),
+                                      ("Registrar", "pbx_config")))
+        chunks.append(self._chunk(("Event", "ShowDialPlanComplete"), ("EventList", "Complete"),
+                                  ("ListItems", str(self.dialplan)), ("ListExtensions", "20"),
+                                  ("ListPriorities", str(self.dialplan)),
+                                  ("ListContexts", str(self.dialplan // 20)), ("ActionID", aid)))
+        return "".join(chunks)
+
+    def stream(self, events=10000):
+        """
+        Return Ami text stream (starting with the banner) of roughly 'events' events.
+        """
+        names = sorted(self.mix)
+        weights = [self.mix[name] for name in names]
+        total = float(sum(weights))
+        chunks = [self.banner + self.nl]
+        count = 0
+        while count < events:
+            pick = self.rnd.random() * total
+            for name, weight in zip(names, weights):
+                pick -= weight
+                if pick < 0: break
+            chunk = getattr(self, name)()
+            chunks.append(chunk)
+            count += chunk.count(self.nl * 2)
+        return "".join(chunks)
+
+
+def peak_rss():
+    """
+    Peak resident memory of the current process (KiB on Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def isolated(func, *a, **kw):
+    """
+    Call 'func' in a forked child process and return its (JSON serializable) result,
+    so peak memory of every call is measured on its own. Exception raised in the child
+    is raised in the parent as RuntimeError carrying the child's traceback.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        try:
+            with os.fdopen(wfd, "w") as out:
+                try:
+                    reply = ["ok", func(*a, **kw)]
+                except BaseException:
+                    reply = ["error", traceback.format_exc()]
+                json.dump(reply, out)
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd, "r") as inp:
+        data = inp.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError("Benchmark process died without result.")
+    status, value = json.loads(data)
+    if status != "ok":
+        raise RuntimeError("Benchmark process failed:\n%s" % value)
+    return value
+
+
+def run(stream, chunk=4096, touch=True, parser=AmiReg):
+    """
+    Feed stream to the parser in 'chunk' sized pieces and return the result dict.
+    - touch: Look up 'Event' header of every event, as most reactors do.
+    peak_rss_kb is the growth of the peak resident memory during the run, so run it
+    in a fresh process (see isolated) to compare the runs.
+    """
+    base_rss = peak_rss()
+    reg = parser()
+    size = len(stream)
+    events = 0
+    start = time.time()
+    for pos in xrange(0, size, chunk):
+        reg.feed(stream[pos:pos + chunk])
+        for event in reg.events:
+            if touch: event.get("Event")
+            events += 1
+    elapsed = max(time.time() - start, 1e-9)
+    return dict(chunk=chunk, events=events, bytes=size, seconds=elapsed,
+                events_sec=events / elapsed, bytes_sec=size / elapsed,
+                peak_buff=reg.buff.peak, peak_rss_kb=peak_rss() - base_rss)
+
+
+def bench(events=20000, chunks=CHUNKS, mix=None, seed=0, touch=True):
+    """
+    Run the benchmark for every chunk size (each in its own process), return list of result dicts.
+    """
+    stream = AmiGen(mix=mix, seed=seed).stream(events)
+    return [ isolated(run, stream, chunk=chunk, touch=touch) for chunk in chunks ]
+
+
+def save(results, path):
+    """
+    Store benchmark results as JSON.
+    """
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    """
+    Load benchmark results stored with 'save'.
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=.1):
+    """
+    Return list of (chunk, baseline events/sec, current events/sec) for every chunk size
+    which got slower than baseline by more than 'tolerance' (fraction).
+    """
+    base = { x["chunk"]: x for x in baseline }
+    slower = []
+    for x in results:
+        old = base.get(x["chunk"])
+        if old and x["events_sec"] < old["events_sec"] * (1 - tolerance):
+            slower.append((x["chunk"], old["events_sec"], x["events_sec"]))
+    return slower
+
+
+def report(results):
+    """
+    Format results as a text table.
+    """
+    head = "%8s %10s %12s %14s %12s %12s" % ("chunk", "events", "events/sec", "bytes/sec", "peak_buff", "peak_rss_kb")
+    rows = [ "%8d %10d %12.0f %14.0f %12d %12d" % (x["chunk"], x["events"], x["events_sec"],
+                                                   x["bytes_sec"], x["peak_buff"], x["peak_rss_kb"])
+             for x in results ]
+    return "\n".join([head] + rows)
+
+
+
+if __name__ == "__main__":
+    import argparse, sys
+    ap = argparse.ArgumentParser(description="AmiReg parser throughput benchmark.")
+    ap.add_argument("--events", type=int, default=20000, help="Number of events to generate.")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed of the generator.")
+    ap.add_argument("--chunks", type=int, nargs="+", default=list(CHUNKS), help="recv chunk sizes.")
+    ap.add_argument("--out", help="Save results to this JSON file.")
+    ap.add_argument("--baseline", help="Compare results against this JSON file.")
+    ap.add_argument("--tolerance", type=float, default=.1, help="Allowed slowdown against baseline.")
+    opts = ap.parse_args()
+
+    results = bench(events=opts.events, chunks=opts.chunks, seed=opts.seed)
+    print report(results)
+    if opts.out:
+        save(results, opts.out)
+    if opts.baseline:
+        slower = compare(results, load(opts.baseline), tolerance=opts.tolerance)
+        for chunk, old, new in slower:
+            print "Regression at chunk %d: %.0f -> %.0f events/sec" % (chunk, old, new)
+        if slower: sys.exit(1)
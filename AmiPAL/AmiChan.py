@@ -0,0 +1,297 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Channel State Index
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+from time import time
+
+
+class AmiChannel(object):
+    """
+    Live channel state.
+    """
+    __slots__ = ("name", "uniqueid", "linkedid", "state", "statedesc", "callerid_num",
+                 "callerid_name", "context", "exten", "priority", "application",
+                 "bridge", "created")
+
+    def __init__(self, name, uniqueid, linkedid=None):
+        self.name = name
+        self.uniqueid = uniqueid
+        self.linkedid = linkedid or uniqueid
+        self.state = self.statedesc = None
+        self.callerid_num = self.callerid_name = None
+        self.context = self.exten = self.priority = self.application = None
+        self.bridge = None   # ID of the bridge channel is in
+        self.created = time()
+
+    def __repr__(self):
+        return "<AmiChannel %s %s %s>" % (self.name, self.uniqueid, self.statedesc)
+
+    def update(self, event):
+        """
+        Update state from the event headers (Asterisk 1.8 - 13+ header names).
+        """
+        get = event.get
+        state = get("ChannelState")
+        if state is not None:
+            self.state = state
+            self.statedesc = get("ChannelStateDesc")
+        num = get("CallerIDNum") or get("CallerIDnum")
+        if num is not None:
+            self.callerid_num = num
+            self.callerid_name = get("CallerIDName") or get("CallerIDname")
+        context = get("Context")
+        if context is not None:
+            self.context = context
+            self.exten = get("Exten") or get("Extension")
+            self.priority = get("Priority")
+        app = get("Application")
+        if app is not None:
+            self.application = app
+
+    @property
+    def d(self):
+        """
+        Channel state as dict.
+        """
+        return { k: getattr(self, k) for k in self.__slots__ }
+
+
+class AmiChan(object):
+    """
+    Ami Channel State Index.
+    """
+
+    def __init__(self):
+        """
+        In-memory model of the live channels, fed by the Ami event stream (see onEvent).
+        Channels are indexed by name, Uniqueid and Linkedid.
+        """
+        self._name = {}       # Channel name -> AmiChannel
+        self._uid = {}        # Uniqueid -> AmiChannel
+        self._lid = {}        # Linkedid -> {Uniqueid: AmiChannel}
+        self._bridge = {}     # Bridge ID -> set of Uniqueids
+        self._gone = set()    # Uniqueids hung up while the snapshot is in flight
+        self._since = None    # When the snapshot in flight was requested (see snapshot)
+        self._handlers = {"Newchannel": self._new, "Newstate": self._update,
+                          "NewCallerid": self._update, "Newexten": self._update,
+                          "Hangup": self._hangup, "Rename": self._rename,
+                          "Bridge": self._bridge_link, "BridgeEnter": self._bridge_enter,
+                          "BridgeLeave": self._bridge_leave}
+
+    def __len__(self):
+        return len(self._uid)
+
+    def __iter__(self):
+        return iter(self._uid.values())
+
+    @property
+    def events(self):
+        """
+        Names of the events the index is interested in (eg. for AmiReg allow list).
+        """
+        return frozenset(self._handlers)
+
+    ## - Lookups - ##
+    def by_name(self, name):
+        return self._name.get(name)
+
+    def by_uniqueid(self, uniqueid):
+        return self._uid.get(uniqueid)
+
+    def by_linkedid(self, linkedid):
+        """
+        Return list of channels of the call.
+        """
+        return list(self._lid.get(linkedid, {}).values())
+
+    def bridged(self, channel):
+        """
+        Return list of the channels in the same bridge as 'channel' (AmiChannel).
+        """
+        members = self._bridge.get(channel.bridge, ())
+        return [ self._uid[x] for x in members if x != channel.uniqueid and x in self._uid ]
+
+    ## - Event stream - ##
+    def onEvent(self, event):
+        """
+        Feed AmiEvent to the index.
+        """
+        handler = self._handlers.get(event.get("Event"))
+        if handler is not None:
+            handler(event)
+
+    def _add(self, chan):
+        self._name[chan.name] = chan
+        self._uid[chan.uniqueid] = chan
+        self._lid.setdefault(chan.linkedid, {})[chan.uniqueid] = chan
+
+    def _remove(self, chan):
+        if self._name.get(chan.name) is chan:
+            del self._name[chan.name]
+        self._uid.pop(chan.uniqueid, None)
+        call = self._lid.get(chan.linkedid)
+        if call is not None:
+            call.pop(chan.uniqueid, None)
+            if not call: del self._lid[chan.linkedid]
+        self._unbridge(chan)
+
+    def _unbridge(self, chan):
+        members = self._bridge.get(chan.bridge)
+        if members is not None:
+            members.discard(chan.uniqueid)
+            if not members: del self._bridge[chan.bridge]
+        chan.bridge = None
+
+    def _get(self, event):
+        uid = event.get("Uniqueid") or event.get("UniqueID")
+        return self._uid.get(uid) if uid else self._name.get(event.get("Channel"))
+
+    def _new(self, event):
+        uid = event.get("Uniqueid") or event.get("UniqueID")
+        name = event.get("Channel")
+        if not uid or not name:
+            return
+        old = self._uid.get(uid)
+        if old is not None:
+            self._remove(old)
+        chan = AmiChannel(name, uid, event.get("Linkedid"))
+        chan.update(event)
+        self._add(chan)
+        return chan
+
+    def _update(self, event):
+        chan = self._get(event)
+        if chan is not None:
+            chan.update(event)
+
+    def _hangup(self, event):
+        chan = self._get(event)
+        if self._since is not None:
+            uid = event.get("Uniqueid") or event.get("UniqueID") or \
+                  (chan.uniqueid if chan is not None else None)
+            if uid: self._gone.add(uid)
+        if chan is not None:
+            self._remove(chan)
+
+    def _rename(self, event):
+        chan = self._get(event)
+        newname = event.get("Newname")
+        if chan is not None and newname:
+            if self._name.get(chan.name) is chan:
+                del self._name[chan.name]
+            chan.name = newname
+            self._name[newname] = chan
+
+    def _join(self, chan, bridge):
+        if chan.bridge != bridge:
+            self._unbridge(chan)
+        chan.bridge = bridge
+        self._bridge.setdefault(bridge, set()).add(chan.uniqueid)
+
+    @staticmethod
+    def _pair(uid1, uid2):
+        """
+        Bridge ID of the two bridged channels on Asterisk 1.8/11 (they have no shared one).
+        """
+        return min(x for x in (uid1, uid2) if x)
+
+    def _bridge_link(self, event):
+        """
+        Asterisk 1.8/11 'Bridge' event (Bridgestate: Link/Unlink).
+        """
+        uid1, uid2 = event.get("Uniqueid1"), event.get("Uniqueid2")
+        chans = [ self._uid.get(uid1), self._uid.get(uid2) ]
+        chans = [ x for x in chans if x is not None ]
+        for chan in chans:
+            if event.get("Bridgestate") == "Unlink":
+                self._unbridge(chan)
+            else:
+                self._join(chan, self._pair(uid1, uid2))
+
+    def _bridge_enter(self, event):
+        chan = self._get(event)
+        if chan is not None:
+            self._join(chan, event.get("BridgeUniqueid"))
+
+    def _bridge_leave(self, event):
+        chan = self._get(event)
+        if chan is not None:
+            self._unbridge(chan)
+
+    ## - Snapshot - ##
+    def snapshot(self):
+        """
+        Mark 'CoreShowChannels' request as sent, return the 'since' time for reconcile.
+        Hangups seen from now on are remembered until reconcile (or cancel).
+        """
+        since = time()
+        if self._since is None:
+            self._since = since
+        return since
+
+    def cancel(self):
+        """
+        Forget the snapshot in flight (eg. the request failed).
+        """
+        self._since = None
+        self._gone.clear()
+
+    def reconcile(self, rows, since=None):
+        """
+        Reconcile the index with 'CoreShowChannels' response rows (list of AmiEvents).
+        Channels missing from the snapshot are dropped, unless they were created after
+        'since' (epoch seconds the snapshot was requested at), as the snapshot can't know them.
+        """
+        # Rows are applied only after the whole list has arrived, so a channel listed
+        # in it could have hung up in the meantime: its Hangup was already processed,
+        # the row must not bring it back (see snapshot)
+        gone = self._gone
+        seen = set()
+        for row in rows:
+            uid = row.get("Uniqueid") or row.get("UniqueID")
+            name = row.get("Channel")
+            if not uid or not name or uid in gone:
+                continue
+            seen.add(uid)
+            chan = self._uid.get(uid)
+            if chan is None:
+                chan = AmiChannel(name, uid, row.get("Linkedid"))
+                self._add(chan)
+            chan.update(row)
+            # 1.8/11 rows carry Uniqueid of the peer channel instead of the bridge ID
+            peer = row.get("BridgedUniqueID")
+            bridge = row.get("BridgeId") or (peer and self._pair(uid, peer))
+            if bridge:
+                self._join(chan, bridge)
+        for chan in list(self._uid.values()):
+            if chan.uniqueid not in seen and (since is None or chan.created < since):
+                self._remove(chan)
+        self.cancel()
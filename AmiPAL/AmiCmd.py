@@ -30,468 +30,933 @@ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF S
 Copyright (c) 2016 Narunas K. All rights reserved.
 """
 
+import gevent, heapq
+from gevent.event import AsyncResult, Event
+from gevent.queue import Queue, Full
+
+# Stdlib
+from collections import OrderedDict, Counter
+from time import time
+
 ## Ami Controller
 from AmiCtl import AmiCtl
+# Command (Action) templates, built-in Commands table
+from AmiAct import AmiAction, AmiError, AmiTimeout, ACTIONS, EVEND
 
 # Main Ami event registry class
 from AmiReg import AmiReg
+# Live channel state index
+from AmiChan import AmiChan
+# Dialplan snapshot
+from AmiPlan import AmiPlan
 
 
 
-class EventParser(AmiReg):
+class AmiResult(AsyncResult):
     """
-    Customized Ami event registry.
+    Future result of the AMI command (Action).
+    Resolves with the response AmiEvent or, for the commands that return list,
+    with the list of AmiEvents. Use get(timeout=...) to wait for it.
     """
-    def __init__(self, *a, **kw):
-        super(EventParser, self).__init__(*a, **kw)
-
-    def onEvent(self, event):
-        if event.od.get('Event') not in ['VarSet','RTCPSent','RTCPReceived']:
-            print "~ # ~"
+    def __init__(self, cid=None):
+        super(AmiResult, self).__init__()
+        # Command ID (ActionID)
+        self.cid = cid
+        # Round-trip time (seconds), set when AMI responds
+        self.rtt = None
+        # Serialized command, kept for the replay after reconnect
+        self.command = None
 
 
-class AmiCmd(AmiCtl):
+class AmiStream(AmiResult):
     """
-    AMI built-in Commands (Actions).
+    Future result of the AMI command that returns list, streamed row by row.
+    Iterate it to get AmiEvents as they are parsed. At most 'window' rows are buffered,
+    the reader is blocked when the buffer is full, so a slow consumer slows down the
+    connection instead of growing the memory. Raises AmiError if command fails.
     """
-    # Cache for commands that return list
-    _cache = {}
-    # List of Command IDs waiting for response
-    _pending = set()
-    # End event headers of the commands that return list
-    _evend = {"RegistrationsComplete", "PeerlistComplete",
-              "ParkedCallsComplete", "AgentsComplete",
-              "StatusComplete", "ShowDialPlanComplete",
-              "CoreShowChannelsComplete"}
-
-    def __init__(self, **kwargs):
-        super(AmiCmd, self).__init__(**kwargs)
-        # Response timeout between retries
-        self._sec_towait = 1
-        self._re_timeout = .2
-        # Stream to python object parser
-        self.parser = AmiReg()
+    _end = object()   # Wakes up the consumer waiting for rows, when the command is done
 
+    def __init__(self, cid=None, window=1000):
+        super(AmiStream, self).__init__(cid)
+        self.count = 0                          # Rows received
+        self._rows = Queue(max(int(window), 1))
 
-    def reactor(self, recv, *a, **kw):
+    def append(self, row):
         """
-        React, when data is received.
+        Push the row to the consumer, blocking while the buffer is full.
+        Rows are dropped once the command has failed (eg. timed out).
         """
-        cache = self._cache
-        pending = self._pending
-        evend = self._evend
-        # Feed data to parser
-        self.parser.feed(recv)
-        for event in self.parser.events:
-            # Event as OrderedDict
-            od = event.od
-            # Command ID
-            cid = od.get("ActionID")
+        while not self.ready():
+            try:
+                self._rows.put(row, timeout=.5)
+                self.count += 1
+                return
+            except Full:
+                pass
 
-            if od.get("Event") in evend and cid in pending and cid in cache:
-                for x in cache[cid]:
-                    print x
-                print
-                del cache[cid]
-                pending.discard(cid)
-            elif cid in pending and cid in cache:
-                cache[cid].append(event.od)
-            elif od.get("Response")=="Success" and cid in pending and cid not in cache:
-                for x in event.d:
-                    print x
-                print
-                self._pending.discard(cid)
+    def _wakeup(self):
+        if not self._rows.full():
+            self._rows.put_nowait(self._end)
 
+    def set(self, value=None):
+        super(AmiStream, self).set(self)
+        self._wakeup()
 
-    def __query(self, action, required, optional, a, kw, evend=None):
-        """
-        Private helper method to handle multi-argument input.
-        """
-        args_ini = {k:"" for k in required + optional}
-        # If there are required args and none are supplied via 'a' or 'kw'
-        if required and not any([a, kw]):
-            raise ValueError("Err :-: Please supply all required arguments: (%s)" % ', '.join(required))
-        if self.soc.connected:
-            if all([a,kw]): return  # disallow argument mixing
-            # Positional arguments can only be used for the required args input if there are any
-            if a and len(a) == len(required):
-                args_ini.update({k: a[required.index(k)] for k in required})
-            # Make sure that all required args are supplied via kw, if kw is the input method
-            if kw and len(kw) >= len(required):
-                keys = kw.keys()
-                if required and not all([k in keys for k in required]):
-                    raise ValueError("Err :-: Please supply all required arguments: (%s)" % ', '.join(required))
-                args_ini.update({k: kw.get(k) for k in required + optional})
-            # Extract final set of arguments
-            args = {k:v for k,v in args_ini.items() if v}
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action, **args)
-            self._pending.add(req_id)
-            return req_id
+    def set_exception(self, exception, *a):
+        super(AmiStream, self).set_exception(exception, *a)
+        self._wakeup()
 
+    def __iter__(self):
+        rows = self._rows
+        while True:
+            if rows.empty() and self.ready():
+                if self.exception is not None:
+                    raise self.exception
+                return
+            row = rows.get()
+            if row is not self._end:
+                yield row
 
-    def Ping(self, *a, **kw):
+    def collect(self):
         """
-        A 'Ping' action will ellicit a 'Pong' response.
-        Used to keep the manager connection open.
+        Return list of all rows.
         """
-        action = "Ping"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            return req_id
+        return list(self)
 
 
-    def ListCommands(self, *a, **kw):
+class AmiPending(object):
+    """
+    Registry of the commands waiting for response.
+    """
+
+    def __init__(self, size=10000, ttl=60):
         """
-        Returns the action name and synopsis for every action that is
-        available to the user.
+        Track at most 'size' pending commands, each of them for at most 'ttl' seconds.
+        Oldest command is evicted when the registry is full, expired ones are failed with AmiTimeout.
         """
-        action = "ListCommands"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            return req_id
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self.timedout = 0                 # Commands failed because of the deadline
+        self.evicted = 0                  # Commands dropped because registry was full
+        self._results = OrderedDict()     # Command ID -> AmiResult (oldest first)
+        self._rows = {}                   # Command ID -> list of events, for commands that return list
+        self._deadlines = []              # Heap of (deadline, command ID)
+
+    def __len__(self):
+        return len(self._results)
 
+    def __contains__(self, cid):
+        return cid in self._results
 
-    def SIPshowregistry(self, *a, **kw):
+    def __iter__(self):
         """
-        Show SIP registrations (text format).
+        Iterate pending AmiResults, oldest first.
         """
-        action = "SIPshowregistry"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            self._cache[req_id] = []
-            return req_id
+        return iter(self._results.values())
 
+    @property
+    def stats(self):
+        return dict(pending=len(self._results), timedout=self.timedout, evicted=self.evicted)
 
-    def SIPpeers(self, *a, **kw):
+    @property
+    def next_deadline(self):
         """
-        Lists SIP peers in text format with details on current status.
+        Earliest deadline (epoch seconds) or None.
         """
-        action = "SIPpeers"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            self._cache[req_id] = []
-            return req_id
+        return self._deadlines[0][0] if self._deadlines else None
 
-
-    def SIPshowpeer(self, *a, **kw):
+    def add(self, result, listing=False, ttl=None):
         """
-        Show one SIP peer with details on current status.
-        Required args:
-            - Peer: The peer name you want to check.
+        Register AmiResult of the sent command.
         """
-        action = "SIPshowpeer"
-        required = ["Peer"]
-        optional = []
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        cid = result.cid
+        self._results[cid] = result
+        if listing:
+            self._rows[cid] = result if isinstance(result, AmiStream) else []
+        deadlines = self._deadlines
+        heapq.heappush(deadlines, (time() + (self.ttl if ttl is None else ttl), cid))
+        # Heap entries of finished commands are only removed when they expire, compact it
+        if len(deadlines) > 2 * (len(self._results) + self.size):
+            self._deadlines = deadlines = [ x for x in deadlines if x[1] in self._results ]
+            heapq.heapify(deadlines)
+        while len(self._results) > self.size:
+            old, res = self._results.popitem(last=False)
+            self._rows.pop(old, None)
+            self.evicted += 1
+            res.set_exception(AmiError("Pending command evicted: %s" % old))
 
+    def get(self, cid):
+        return self._results.get(cid)
 
-    def SIPqualifypeer(self, *a, **kw):
+    def rows(self, cid):
         """
-        Qualify a SIP peer.
-        # Required args:
-            - Peer: The peer name you want to qualify.
+        List of the events collected so far (AmiStream, for the streamed commands)
+        or None if command doesn't return list.
         """
-        action = "SIPqualifypeer"
-        required = ["Peer"]
-        optional = []
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        return self._rows.get(cid)
 
+    def pop(self, cid):
+        """
+        Stop tracking the command, return (AmiResult, rows) tuple.
+        """
+        return self._results.pop(cid, None), self._rows.pop(cid, None)
 
-    def ShowDialPlan(self, *a, **kw):
+    def restart(self, cid):
         """
-        Show dialplan contexts and extensions. Be aware that showing the full
-        dialplan may take a lot of capacity.
-        # Optional args:
-            - Extension: Show a specific extension.
-            - Context: Show a specific context.
+        Drop the rows collected so far, as the command is going to be sent again.
         """
-        action = "ShowDialPlan"
-        required = []
-        optional = ["Extension", "Context"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw, evend='ShowDialPlanComplete')
-        self._cache[req_id] = []
-        return req_id
+        if isinstance(self._rows.get(cid), list):
+            self._rows[cid] = []
 
+    def fail(self, exception, cids=None):
+        """
+        Fail the pending commands (all of them or the ones listed in 'cids') with the exception.
+        """
+        for cid in list(self._results if cids is None else cids):
+            result, rows = self.pop(cid)
+            if result is not None:
+                result.set_exception(exception)
 
-    def Context(self, *a, **kw):
+    def expire(self, now=None):
         """
-        Custom method. List unique dialplan contexts.
-        # Optional args:
-            - Extension: Show a specific extension.
+        Fail the commands whose deadline has passed, return list of their IDs.
         """
-        return sorted({x.od['Context'] for x in self.ShowDialPlan(*a, **kw) if x.od.get('Context')})
+        now = time() if now is None else now
+        deadlines = self._deadlines
+        expired = []
+        while deadlines and deadlines[0][0] <= now:
+            cid = heapq.heappop(deadlines)[1]
+            result, rows = self.pop(cid)
+            if result is not None:
+                self.timedout += 1
+                expired.append(cid)
+                result.set_exception(AmiTimeout("No response for command: %s" % cid))
+        return expired
 
 
-    def Originate(self, *a, **kw):
+class AmiBulk(object):
+    """
+    Windowed bulk command runner.
+    """
+
+    def __init__(self, send, items, window=100, name=None):
+        """
+        Call 'send' (returning AmiResult) for every item, keeping at most 'window' results pending.
+        Iterate to get (item, AmiResult) tuples in the order of completion.
+        """
+        self.name = name
+        self.window = max(int(window), 1)
+        self.sent = 0
+        self.ok = 0
+        self.failed = 0
+        self.latency = []          # Round-trip times of the answered commands
+        self.started = None
+        self.finished = None
+        self._send = send
+        self._items = iter(items)
+
+    def __iter__(self):
+        done = Queue()
+        inflight = 0
+        exhausted = False
+        self.started = time()
+        while True:
+            while not exhausted and inflight < self.window:
+                try:
+                    item = next(self._items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                result = self._send(item)
+                result.rawlink(lambda res, item=item: done.put((item, res)))
+                inflight += 1
+                self.sent += 1
+            if not inflight:
+                break
+            item, result = done.get()
+            inflight -= 1
+            if result.successful():
+                self.ok += 1
+            else:
+                self.failed += 1
+            if result.rtt is not None:
+                self.latency.append(result.rtt)
+            yield item, result
+        self.finished = time()
+
+    @property
+    def throughput(self):
+        """
+        Completed commands per second.
+        """
+        if self.started is None:
+            return 0.
+        elapsed = (self.finished or time()) - self.started
+        return (self.ok + self.failed) / elapsed if elapsed > 0 else 0.
+
+    def percentiles(self, pct=(50, 90, 99)):
+        """
+        Return {percentile: latency seconds} of the answered commands.
+        """
+        lat = sorted(self.latency)
+        if not lat:
+            return {}
+        return { p: lat[min(int(round(p / 100. * (len(lat) - 1))), len(lat) - 1)] for p in pct }
+
+    @property
+    def stats(self):
+        return dict(action=self.name, sent=self.sent, ok=self.ok, failed=self.failed,
+                    throughput=self.throughput, latency=self.percentiles())
+
+
+class AmiCache(object):
+    """
+    Query cache of the read-only SIP peer / registry commands.
+    """
+    # Cached action name -> name of the argument, the entry is keyed by
+    actions = {"SIPpeers": None, "SIPshowregistry": None, "SIPshowpeer": "Peer"}
+
+    def __init__(self, ttl=5):
+        """
+        Keep AmiResults for at most 'ttl' seconds (0 disables the cache). Entries are
+        invalidated earlier by PeerStatus / Registry events, see onEvent.
         """
-        Generates an outgoing call to a <Extension>/<Context>/<Priority> or
-        <Application>/<Data>.
-        # Required args:
-            - Channel: Channel name to call.
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._entries = {}        # (action, key) -> (expiry, AmiResult)
+        self._sweep_at = 0        # When expired entries are removed next time (see add)
+        self._handlers = {"PeerStatus": self._peer, "Registry": self._registry,
+                          "Reload": self._reload}
 
-        # Optional args:
-            - Exten: Extension to use (requires 'Context' and 'Priority')
-            - Context: Context to use (requires 'Exten' and 'Priority')
-            - Priority: Priority to use (requires 'Exten' and 'Context')
-            - Application: Application to execute.
-            - Data: Data to use (requires 'Application').
-            - Timeout: How long to wait for call to be answered (in ms.).
-            - CallerID: Caller ID to be set on the outgoing channel.
-            - Variable: Channel variable to set, multiple Variable: headers are allowed.
-            - Account: Account code.
-            - Async: Set to 'true' for fast origination.
-            - Codecs: Comma-separated list of codecs to use for this call.
-
-        e.g. dict(Channel="SIP/965", Exten="965", Context="default",
-                  Priority="1", CallerID="666", Timeout="10000", Async="Yes")
-             dict(Channel="SIP/965", CallerID="666", Timeout="10000", Async="Yes")
-        """
-        action = "Originate"
-        required = ["Channel"]
-        optional = ["Exten", "Context", "Priority", "Application", "Data", "Timeout",
-                    "CallerID", "Variable", "Account", "Async", "Codecs"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
-
-
-    def Hangup(self, *a, **kw):
-        """
-        Hangup channel.
-        # Required args:
-            - Channel: Channel name to be hangup.
+    def __len__(self):
+        return len(self._entries)
 
-        # Optional args:
-            - Cause: Numeric hangup cause.
+    @property
+    def events(self):
+        """
+        Names of the events invalidating the cache.
         """
-        action = "Hangup"
-        required = ["Channel"]
-        optional = ["Cause"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        return frozenset(self._handlers)
 
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(entries=len(self._entries), hits=self.hits, misses=self.misses,
+                    invalidated=self.invalidated, ratio=float(self.hits) / total if total else 0.)
 
-    def Redirect(self, *a, **kw):
+    def key(self, action, args):
+        """
+        Cache key of the command or None if it's not cached.
         """
-        Redirect (transfer) a call.
-        # Required args:
-            - Channel: Channel to redirect.
-            - Exten: Extension to transfer to.
-            - Context: Context to transfer to.
-            - Priority: Priority to transfer to.
+        if self.ttl <= 0 or action not in self.actions:
+            return
+        arg = self.actions[action]
+        return action, args.get(arg) if arg else None
 
-        # Optional args:
-            - ExtraChannel: Second call leg to transfer (optional).
-            - ExtraExten: Extension to transfer extrachannel to (optional).
-            - ExtraContext: Context to transfer extrachannel to (optional).
-            - ExtraPriority: Priority to transfer extrachannel to (optional).
+    def get(self, key):
+        """
+        Return cached AmiResult (maybe still pending) or None.
         """
-        action = "Redirect"
-        required = ["Channel", "Exten", "Context", "Priority"]
-        optional = ["ExtraChannel", "ExtraExten", "ExtraContext", "ExtraPriority"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time():
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+        self.misses += 1
 
+    def add(self, key, result):
+        now = time()
+        # Entries which are never asked for again are removed once per ttl
+        if now >= self._sweep_at:
+            self.sweep(now)
+            self._sweep_at = now + self.ttl
+        self._entries[key] = (now + self.ttl, result)
+        # Errors are not cached
+        result.rawlink(lambda res: res.successful() or self._drop(key, res))
 
-    def Atxfer(self, *a, **kw):
+    def sweep(self, now=None):
         """
-        Attended transfer.
-        # Required args:
-            - Channel: Transferer's channel.
-            - Exten: Extension to transfer to.
-            - Context: Context to transfer to.
-            - Priority: Priority to transfer to.
+        Remove expired entries.
         """
-        action = "Atxfer"
-        required = ["Channel", "Exten", "Context", "Priority"]
-        optional = []
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        now = time() if now is None else now
+        for key in [ k for k, v in self._entries.iteritems() if v[0] <= now ]:
+            del self._entries[key]
 
+    def _drop(self, key, result=None):
+        entry = self._entries.get(key)
+        if entry is not None and (result is None or entry[1] is result):
+            del self._entries[key]
+            return True
 
-    def PlayDTMF(self, *a, **kw):
+    def invalidate(self, action=None, key=None):
         """
-        Play DTMF digit (signal) on a specific channel.
-        # Required args:
-            - Channel: Channel name to send digit to.
-            - Digit: The DTMF digit to play.
+        Drop cached entries of the action (all of them, when 'action' is None).
         """
-        action = "PlayDTMF"
-        required = ["Channel", "Digit"]
-        optional = []
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        if action is None:
+            self.invalidated += len(self._entries)
+            self._entries.clear()
+        elif self._drop((action, key)):
+            self.invalidated += 1
 
+    def onEvent(self, event):
+        handler = self._handlers.get(event.get("Event"))
+        if handler is not None and self._entries:
+            handler(event)
 
-    def Bridge(self, *a, **kw):
-        """
-        Bridge together two channels already in the PBX.
-        # Required args:
-            - Channel1: Channel to Bridge to Channel2.
-            - Channel2: Channel to Bridge to Channel1.
+    def _peer(self, event):
+        peer = event.get("Peer") or ""
+        if event.get("ChannelType", "SIP") != "SIP" or not peer.startswith("SIP/"):
+            return
+        self.invalidate("SIPshowpeer", peer[4:])
+        self.invalidate("SIPpeers")
 
-        # Optional args:
-            - Tone: Play courtesy tone to Channel2 (yes/no).
-        """
-        action = "Bridge"
-        required = ["Channel1", "Channel2"]
-        optional = ["Tone"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+    def _registry(self, event):
+        if event.get("ChannelType", "SIP") == "SIP":
+            self.invalidate("SIPshowregistry")
 
+    def _reload(self, event):
+        self.invalidate()
 
-    def Park(self, *a, **kw):
-        """
-        Park a channel.
-        # Required args:
-            - Channel: Channel name to park.
-            - Channel2: Channel to return to if timeout.
 
-        # Optional args:
-            - Timeout: Number of milliseconds to wait before callback.
-            - Parkinglot: Specify in which parking lot to park the channel.
-        """
-        action = "Park"
-        required = ["Channel", "Channel2"]
-        optional = ["Timeout", "Parkinglot"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+class AmiCampaign(object):
+    """
+    Paced Originate campaign.
+    """
+    # OriginateResponse reason codes
+    reasons = {"0": "failed", "1": "hangup", "3": "noanswer", "4": "answered",
+               "5": "busy", "8": "congestion"}
+    # Seconds a call is tracked at most, in case its ending events are lost
+    call_ttl = 3600
+    # Seconds to wait before the call is tried again, while connection is down
+    retry_delay = 1.
+
+    def __init__(self, send, specs, cps=1, concurrent=10, name=None, call_ttl=None):
+        """
+        Originate a call for every argument dict from the 'specs' iterable (sent with Async),
+        at most 'cps' calls per second and at most 'concurrent' live calls at once.
+        A call is live from sending until its OriginateResponse fails, its channel hangs up
+        or 'call_ttl' seconds pass (see release for the calls lost with the connection).
+        - send: Callable sending the Originate arguments, returning AmiResult.
+        """
+        if not cps > 0:
+            raise ValueError("cps must be greater than 0")
+        if int(concurrent) < 1:
+            raise ValueError("concurrent must be at least 1")
+        self.name = name
+        if call_ttl is not None:
+            self.call_ttl = float(call_ttl)
+        self.interval = 1. / cps
+        self.concurrent = int(concurrent)
+        self.sent = 0
+        self.answered = 0
+        self.failed = 0
+        self.completed = 0
+        self.outcomes = Counter()    # Reason -> number of calls
+        self.started = None
+        self.finished = None
+        self.stopped = False
+        self._send = send
+        self._specs = iter(specs)
+        self._live = {}              # Command ID -> Uniqueid of the answered call (or None)
+        self._uids = {}              # Uniqueid -> Command ID
+        self._deadlines = {}         # Command ID -> epoch seconds the call is given up at
+        self._freed = Event()
+        self._runner = None
+        self._handlers = {"OriginateResponse": self._response, "Hangup": self._hangup}
+
+    @property
+    def live(self):
+        return len(self._live)
+
+    @property
+    def events(self):
+        """
+        Names of the events tracking the calls.
+        """
+        return frozenset(self._handlers)
+
+    def start(self):
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+        return self
+
+    def stop(self):
+        """
+        Don't originate more calls, live ones are still tracked.
+        """
+        self.stopped = True
+
+    def join(self, timeout=None):
+        """
+        Wait until all calls are originated and finished.
+        """
+        if self._runner is not None:
+            self._runner.join(timeout=timeout)
+        return self.finished is not None
+
+    def _wait(self, limit):
+        while len(self._live) > limit:
+            self._freed.clear()
+            self._freed.wait(timeout=max(min(self._deadlines.values()) - time(), 0))
+            self.expire()
+
+    def expire(self, now=None):
+        """
+        Stop tracking the calls whose deadline has passed.
+        """
+        now = time() if now is None else now
+        for cid in [ k for k, v in self._deadlines.iteritems() if v <= now ]:
+            self._end(cid, "timeout")
+
+    def release(self, reason="lost"):
+        """
+        Stop tracking all live calls, eg. when connection drops and their events are lost.
+        """
+        for cid in list(self._live):
+            self._end(cid, reason)
+
+    def _run(self):
+        self.started = next_at = time()
+        for spec in self._specs:
+            if self.stopped:
+                break
+            self._wait(self.concurrent - 1)
+            delay = next_at - time()
+            if delay > 0:
+                gevent.sleep(delay)
+            # Never catch up on the missed slots, so the rate is never exceeded
+            next_at = max(next_at, time()) + self.interval
+            while not self._originate(spec) and not self.stopped:
+                gevent.sleep(self.retry_delay)
+        self._wait(0)
+        self.finished = time()
+
+    def _originate(self, spec):
+        args = dict(spec)
+        args["Async"] = "true"
+        try:
+            result = self._send(args)
+        except IOError:
+            # Connection is down
+            return False
+        self.sent += 1
+        self._live[result.cid] = None
+        self._deadlines[result.cid] = time() + self.call_ttl
+        result.rawlink(self._acked)
+        return True
+
+    def _acked(self, result):
+        """
+        Originate is acknowledged. Unanswered one (AmiTimeout) may still be placed,
+        so it keeps its slot until its events come or call_ttl passes.
+        """
+        if not result.successful() and not isinstance(result.exception, AmiTimeout):
+            self._end(result.cid, "error")
+
+    def _end(self, cid, reason):
+        if cid not in self._live:
+            return
+        uid = self._live.pop(cid)
+        self._uids.pop(uid, None)
+        self._deadlines.pop(cid, None)
+        self.outcomes[reason] += 1
+        self.completed += 1
+        # Answered calls which are not tracked to the end are not failed ones
+        if reason != "answered" and uid is None:
+            self.failed += 1
+        self._freed.set()
 
+    def onEvent(self, event):
+        handler = self._handlers.get(event.get("Event"))
+        if handler is not None and self._live:
+            handler(event)
+
+    def _response(self, event):
+        cid = event.get("ActionID")
+        if cid not in self._live:
+            return
+        reason = event.get("Reason")
+        reason = self.reasons.get(reason, reason or "failed")
+        uid = event.get("Uniqueid")
+        if event.get("Response") != "Success" or reason != "answered":
+            return self._end(cid, reason)
+        self.answered += 1
+        if not uid or uid == "<null>":
+            return self._end(cid, reason)
+        self._live[cid] = uid
+        self._uids[uid] = cid
+
+    def _hangup(self, event):
+        cid = self._uids.get(event.get("Uniqueid"))
+        if cid is not None:
+            self._end(cid, "answered")
+
+    @property
+    def throughput(self):
+        """
+        Originated calls per second.
+        """
+        if self.started is None:
+            return 0.
+        elapsed = (self.finished or time()) - self.started
+        return self.sent / elapsed if elapsed > 0 else 0.
+
+    @property
+    def answer_rate(self):
+        """
+        Fraction of the resolved calls which were answered.
+        """
+        resolved = self.answered + self.failed
+        return float(self.answered) / resolved if resolved else 0.
+
+    @property
+    def stats(self):
+        return dict(campaign=self.name, sent=self.sent, live=self.live, answered=self.answered,
+                    failed=self.failed, completed=self.completed, outcomes=dict(self.outcomes),
+                    throughput=self.throughput, answer_rate=self.answer_rate)
 
-    def ParkedCalls(self, *a, **kw):
-        """
-        List parked calls.
-        """
-        action = "ParkedCalls"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            self._cache[req_id] = []
-            return req_id
 
+class EventParser(AmiReg):
+    """
+    Customized Ami event registry.
+    """
+    def __init__(self, *a, **kw):
+        kw.setdefault("deny", ['VarSet','RTCPSent','RTCPReceived'])
+        super(EventParser, self).__init__(*a, **kw)
 
-    def Queues(self, *a, **kw):
-        """
-        Show queues information. Check the log for the output
-        """
-        action = "Queues"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
+    def onEvent(self, event):
+        print "~ # ~"
+
+
+class AmiCmd(AmiCtl):
+    """
+    AMI built-in Commands (Actions).
+    """
+    # Action name -> AmiAction, methods are generated from the ACTIONS table
+    _actions = { x.name: x for x in ACTIONS }
+    # End event headers of the commands that return list
+    _evend = EVEND
+    # List commands return AmiStream instead of collecting all rows (override with stream=...)
+    stream = False
+    # Rows buffered by AmiStream before the reader is blocked
+    stream_window = 1000
+    # What happens to the commands pending when connection drops:
+    # "fail" them with AmiError or "replay" them after reconnect
+    pending_policy = "fail"
+
+    def __init__(self, **kwargs):
+        super(AmiCmd, self).__init__(**kwargs)
+        # Response timeout between retries
+        self._sec_towait = 1
+        self._re_timeout = .2
+        # Stream to python object parser
+        self.parser = AmiReg(want=self._want)
+        # Optional multi-core parse / dispatch pool (AmiPool), events not carrying
+        # ActionID are handled by its workers, the subscribed ones (see on) here as well
+        self.pool = kwargs.get("pool")
+        if self.pool is not None:
+            self.pool.want = self.handlers.wanted
+        # Commands waiting for response
+        self._pending = AmiPending(size=kwargs.get("max_pending") or 10000,
+                                   ttl=kwargs.get("pending_ttl") or 60)
+        self._sweeper = None
+        self._sweep_at = None
+        if kwargs.get("pending_policy"):
+            self.pending_policy = kwargs["pending_policy"]
+        if self.pending_policy not in ("fail", "replay"):
+            raise ValueError("pending_policy must be 'fail' or 'replay'")
+        # Query cache of the SIP peer / registry commands
+        self.cache = AmiCache(ttl=kwargs.get("cache_ttl", 5))
+        if self.cache.ttl > 0:
+            for name in self.cache.events:
+                self.on(name, self.cache.onEvent)
+        # Live channel state (see track_channels)
+        self.channels = None
+        # Dialplan snapshot (see load_dialplan)
+        self.dialplan = None
+        # Running Originate campaigns (see campaign)
+        self._campaigns = set()
 
 
-    def Agents(self, *a, **kw):
+    def reactor(self, recv, *a, **kw):
         """
-        Will list info about all possible agents.
+        React, when data is received.
         """
-        if self.soc.connected:
-            action = "Agents"
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            self._cache[req_id] = []
-            return req_id
+        pending = self._pending
+        evend = self._evend
+        dispatch = self.handlers.dispatch
+        # Feed data to parser
+        if self.pool is not None:
+            events = [ self.parser.parse(x) for x in self.pool.feed(recv) ]
+        else:
+            self.parser.feed(recv)
+            events = self.parser.events
+        for event in events:
+            dispatch(event)
+            # Command ID
+            cid = event.get("ActionID")
+            result = pending.get(cid)
+            if result is None:
+                continue
+            response = event.get("Response")
+            rows = pending.rows(cid)
+
+            if response == "Error":
+                pending.pop(cid)
+                result.rtt = self.ids.done(cid)
+                result.set_exception(AmiError(event.get("Message"), event))
+            elif rows is not None:
+                if event.get("Event") in evend:
+                    pending.pop(cid)
+                    result.rtt = self.ids.done(cid)
+                    result.set(rows)
+                elif not response:
+                    rows.append(event)
+            elif response:
+                pending.pop(cid)
+                result.rtt = self.ids.done(cid)
+                result.set(event)
+    reactor.dispatching = True
 
 
-    def CoreShowChannels(self, *a, **kw):
+    @property
+    def pending_stats(self):
         """
-        List currently defined channels and some information about them.
+        Pending command statistics: number of commands waiting for response and the
+        ones failed because of their deadline (timedout) or a full registry (evicted).
         """
-        action = "CoreShowChannels"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            self._cache[req_id] = []
-            return req_id
+        return self._pending.stats
 
 
-    def CoreStatus(self, *a, **kw):
+    def _disconnected(self):
         """
-        Show PBX core status variables.
+        Drop the half received event, fail pending commands unless they are replayed.
         """
-        action = "CoreStatus"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            return req_id
+        super(AmiCmd, self)._disconnected()
+        self.parser.buff.clear()
+        if self.pool is not None:
+            self.pool.buff.clear()
+        if self.pending_policy == "fail":
+            self._pending.fail(AmiError("Connection lost"))
+        for campaign in list(self._campaigns):
+            campaign.release()
 
 
-    def CoreSettings(self, *a, **kw):
+    def _reconnected(self):
         """
-        Show PBX core settings (version etc).
+        Replay pending commands and resync the state missed while disconnected.
         """
-        action = "CoreSettings"
-        if self.soc.connected:
-            # Send command to AMI and capture request id
-            req_id = self.cmd(action)
-            self._pending.add(req_id)
-            return req_id
+        pending = self._pending
+        if self.pending_policy == "replay":
+            # Streams which have already yielded rows can't be restarted
+            broken = [ x.cid for x in pending if isinstance(x, AmiStream) and x.count ]
+            pending.fail(AmiError("Connection lost"), broken)
+            for result in list(pending):
+                pending.restart(result.cid)
+                self._send(result.command)
+        self.cache.invalidate()
+        if self.channels is not None:
+            self.track_channels()
 
 
-    def Status(self, *a, **kw):
+    def _sweep(self):
         """
-        Will return the status information of each channel along with the
-        value for the specified channel variables.
-        # Optional args:
-            - Channel: The name of the channel to query for status.
-            - Variables: Comma ',' separated list of variable to include.
+        Fail pending commands when their deadline passes. Runs while there are any.
         """
-        action = "Status"
-        required = []
-        optional = ["Channel", "Variables"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw, evend="StatusComplete")
-        self._cache[req_id] = []
-        return req_id
+        pending = self._pending
+        while len(pending):
+            self._sweep_at = pending.next_deadline
+            gevent.sleep(max(self._sweep_at - time(), 0))
+            for cid in pending.expire():
+                self.ids.sent.pop(cid, None)
+        self._sweeper = None
+
+
+    @staticmethod
+    def gather(results, timeout=None):
+        """
+        Wait for all AmiResults (at most 'timeout' seconds) and return the list of their
+        values. Failed and unfinished results are represented by their exception / None.
+        """
+        results = list(results)
+        gevent.wait(results, timeout=timeout)
+        return [ x.value if x.successful() else x.exception for x in results ]
+
+
+    def bulk(self, action, items, window=100, ttl=None):
+        """
+        Run 'action' for every argument dict from the 'items' iterable, keeping at most
+        'window' commands in flight. Returns AmiBulk: iterate it to get (args, AmiResult)
+        tuples as they complete, see its stats for throughput and latency percentiles.
+        Arguments are sent as given (no per-call validation).
+        - ttl: Seconds to wait for every single response.
+        """
+        spec = self._actions.get(action) or AmiAction(action)
+        send = lambda args: self.__request(spec, args, ttl=ttl)
+        return AmiBulk(send, items, window=window, name=action)
+
+
+    def campaign(self, specs, cps=1, concurrent=10, ttl=None, call_ttl=None):
+        """
+        Start paced Originate campaign, see AmiCampaign. Returns the running campaign,
+        watch its stats for throughput and answer rate.
+        - specs: Iterable of Originate argument dicts (sent as given, with Async).
+        - cps: Calls per second.
+        - concurrent: Maximum number of live calls.
+        - ttl: Seconds to wait for every single Originate response.
+        - call_ttl: Seconds a live call is tracked at most (see AmiCampaign.call_ttl).
+        Live calls are released when connection drops, as their events are lost.
+        """
+        spec = self._actions["Originate"]
+        send = lambda args: self.__request(spec, args, ttl=ttl)
+        campaign = AmiCampaign(send, specs, cps=cps, concurrent=concurrent, call_ttl=call_ttl)
+        tokens = [ self.on(name, campaign.onEvent) for name in campaign.events ]
+        self._campaigns.add(campaign)
+
+        def done(g):
+            self._campaigns.discard(campaign)
+            for token in tokens:
+                self.off(token)
+        campaign.start()._runner.link(done)
+        return campaign
+
+
+    def _call(self, spec, a, kw):
+        """
+        Validate input and send the command described by AmiAction spec.
+        Keyword 'ttl' sets the response deadline (seconds) of this very command,
+        'fresh=True' bypasses the query cache (see AmiCache) and refreshes the entry.
+        For the commands that return list 'stream=True' returns AmiStream (rows are yielded
+        as they arrive, not cached), 'stream=False' collects all rows into a list.
+        """
+        ttl = kw.pop("ttl", None)
+        fresh = kw.pop("fresh", False)
+        stream = kw.pop("stream", self.stream)
+        args = spec.args(a, kw)
+        if args is None or not self.soc.connected:
+            return
+        if stream and spec.listing:
+            return self.__request(spec, args, ttl=ttl, stream=True)
+        cache = self.cache
+        key = cache.key(spec.name, args)
+        if key is None:
+            return self.__request(spec, args, ttl=ttl)
+        result = None if fresh else cache.get(key)
+        if result is None:
+            result = self.__request(spec, args, ttl=ttl)
+            cache.add(key, result)
+        return result
+
+
+    def __request(self, spec, args=None, ttl=None, stream=False):
+        """
+        Private helper method to send command and register its AmiResult.
+        """
+        # Send command to AMI and capture request id
+        req_id = self._id
+        command = spec.serialize(req_id, args)
+        self._send(command)
+        result = AmiStream(req_id, self.stream_window) if stream else AmiResult(req_id)
+        result.command = command
+        pending = self._pending
+        pending.add(result, listing=spec.listing, ttl=ttl)
+        # (Re)start sweeper, so it wakes up for the earliest deadline
+        sweeper = self._sweeper
+        if sweeper is None or pending.next_deadline < self._sweep_at:
+            if sweeper is not None:
+                sweeper.kill(block=False)
+            self._sweeper = gevent.spawn(self._sweep)
+        return result
+
+
+    def track_channels(self, ttl=None):
+        """
+        Start maintaining live channel state in self.channels (AmiChan), fed by the
+        call events. A single 'CoreShowChannels' reconciles the index with channels which
+        were up before tracking started, no polling is needed afterwards.
+        Returns the 'CoreShowChannels' AmiResult.
+        """
+        if self.channels is None:
+            self.channels = AmiChan()
+            for name in self.channels.events:
+                self.on(name, self.channels.onEvent)
+        channels = self.channels
+        since = channels.snapshot()
+        result = self.CoreShowChannels(ttl=ttl, stream=False)
+        if result is None:
+            channels.cancel()
+        else:
+            result.rawlink(lambda r: channels.reconcile(r.value, since=since)
+                           if r.successful() else channels.cancel())
+        return result
+
+
+    def load_dialplan(self, context=None, ttl=None):
+        """
+        Build (or refresh) the dialplan snapshot in self.dialplan (AmiPlan) from the
+        'ShowDialPlan' response. Only 'context' is reloaded, when given; the context
+        is dropped from the snapshot if Asterisk doesn't know it anymore.
+        Returns AmiResult resolving with the snapshot.
+        """
+        if self.dialplan is None:
+            self.dialplan = AmiPlan()
+        plan, done = self.dialplan, AmiResult()
+        kw = {"Context": context} if context else {}
+        result = self.ShowDialPlan(ttl=ttl, stream=False, **kw)
+        if result is None:
+            return
+
+        def update(res):
+            if res.successful():
+                plan.update(res.value, context=context)
+                done.set(plan)
+            elif context and isinstance(res.exception, AmiError) and \
+                    "not find context" in str(res.exception):
+                plan.drop(context)
+                done.set(plan)
+            else:
+                done.set_exception(res.exception)
+        result.rawlink(update)
+        return done
 
 
-    def GetConfig(self, *a, **kw):
+    def Context(self, *a, **kw):
         """
-        This action will dump the contents of a configuration file by category
-        and contents or optionally by specified category only.
-        # Required args:
-            - Filename: Configuration filename (e.g. "foo.conf").
-
+        Custom method. List unique dialplan contexts.
+        Blocks until the dialplan is received, so don't call it from the reactor.
         # Optional args:
-            - Category: Category in configuration file.
+            - Extension: Show a specific extension.
+            - timeout: Seconds to wait for the dialplan (default: wait forever).
         """
-        action = "GetConfig"
-        required = ["Filename"]
-        optional = ["Category"]
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
+        timeout = kw.pop("timeout", None)
+        result = self.ShowDialPlan(*a, stream=False, **kw)
+        if result is None: return
+        return sorted({x.get('Context') for x in result.get(timeout=timeout) if x.get('Context')})
 
 
-    def GetConfigJSON(self, *a, **kw):
-        """
-        This action will dump the contents of a configuration file by category
-        and contents in JSON format. This only makes sense to be used using rawman
-        over the HTTP interface.
-        # Required args:
-            - Filename: Configuration filename (e.g. "foo.conf").
-        """
-        action = "GetConfigJSON"
-        required = ["Filename"]
-        optional = []
-        req_id = self.__query(action, required, optional, a=a, kw=kw)
-        return req_id
 
+def _action(spec):
+    """
+    Create AmiCmd method sending the command described by AmiAction spec.
+    """
+    def action(self, *a, **kw):
+        return self._call(spec, a, kw)
+    action.__name__ = spec.name
+    action.__doc__ = spec.doc
+    return action
+
+for _spec in ACTIONS:
+    setattr(AmiCmd, _spec.name, _action(_spec))
+del _spec
 
 
 if __name__ == "__main__":
+    from AmiCtl import patch
+    patch()
     host = "127.0.0.2"
     port = 5038
     usr = "ami"
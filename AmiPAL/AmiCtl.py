@@ -30,10 +30,10 @@ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF S
 Copyright (c) 2016 Narunas K. All rights reserved.
 """
 
-from gevent import monkey; monkey.patch_all()
+from gevent import monkey
 import gevent, logging
-from gevent import socket, sleep
-from gevent.queue import Queue
+from gevent import socket
+from gevent.queue import Queue, Empty
 
 # Messaging
 import kombu
@@ -41,10 +41,15 @@ from kombu.exceptions import socket as srv_idle
 
 # Stdlib
 from types import ListType, DictType, StringType
-from datetime import datetime
+from time import time
+import random
 
-# Main Ami event registry class
-from AmiReg import AmiReg
+# Main Ami event registry class, event handler registry
+from AmiReg import AmiReg, AmiHandlers
+# Command (Action) templates and ActionID allocator
+from AmiAct import ActionID, AmiAction
+# Logging helpers
+from AmiLog import AmiRing, AmiSample, Stamp, will_log
 
 
 LOG_NAME = "AmiPAL"
@@ -52,24 +57,47 @@ CTL_LOG = LOG_NAME + "-CTL"
 CTL_ID = "xQtvfosmBYg2w7YHCM0mm7NPfWigXbd7"
 
 
+def patch():
+    """
+    Make the blocking stdlib (sockets, threads, time) cooperative, for the kombu control
+    queue. Never done implicitly: call it yourself first thing in your program, before
+    other modules grab the blocking socket / threading objects.
+    """
+    if not monkey.is_module_patched("socket"):
+        monkey.patch_all()
+
+
 class AmiCtl(object):
     """
     Ami Controller
     """
     nl = "\r\n"        # New line terminator
     timeout = .01      # Global timeout setting
+    flush_size = 65536 # Max bytes of queued commands sent with a single write
+    flush_delay = 0    # Seconds to wait for more commands before the write
     parser = AmiReg()
     log_cfg = dict(type=1, path="./")
+    log_name = LOG_NAME  # Logger name, also the log file name (<path><log_name>.log)
     log, ctllog = [ None ] * 2
+    sampler = None
+    reconnect = True   # Reconnect (with backoff) and log in again when connection drops
+    _actions = {}      # Action name -> AmiAction (precompiled command template)
     _ctl_id = CTL_ID
 
     def __init__(self, usr="ami", pwd="secret", *a, **kw):
         """
         Base Class for connecting, logging in and sending commands to the AMI.
+        The interpreter is not monkey patched (see patch), unless patch=True is given.
+        The control queue (ctl) needs the patched one: by default it is started only
+        if the interpreter is patched, ctl=True on the unpatched one raises RuntimeError.
         """
+        if kw.get("patch"):
+            patch()
         # Configure logger
         if kw.get("log_cfg"):
             self.log_cfg = kw.get("log_cfg")
+        if kw.get("log_name"):
+            self.log_name = str(kw.get("log_name"))
         self._set_logging()
         # Asterisk manager username and password
         self.usr = str(usr)
@@ -78,49 +106,170 @@ class AmiCtl(object):
         host = kw.get("host") or "127.0.0.1"
         port = kw.get("port") or 5038
         buff = kw.get("buff") or 4096
-        self.soc = AmiSocket(host=host, port=port, buff=buff)
+        max_buff = kw.get("max_buff") or 262144
+        zerocopy = kw.get("zerocopy") or False
+        self.soc = AmiSocket(host=host, port=port, buff=buff, max_buff=max_buff, zerocopy=zerocopy,
+                             log_name=self.log_name)
         # Data channel queues
         self._outq = Queue()    # Write queue
-        # Control messaging queue
-        self._ctlq = CTLQueue('AMI_CTL', on_recv=[self._ctl_handler])
+        # Write coalescing
+        self.flush_size = int(kw.get("flush_size") or self.flush_size)
+        self.flush_delay = float(kw.get("flush_delay") or self.flush_delay)
+        self.wstats = dict(flushes=0, commands=0, bytes=0, last_commands=0, last_bytes=0)
+        # Control messaging queue (ctl=False disables it, eg. for the nodes of AmiHub).
+        # kombu blocks on the plain sockets, it would freeze all greenlets unpatched
+        ctl, patched = kw.get("ctl"), monkey.is_module_patched("socket")
+        if ctl and not patched:
+            raise RuntimeError("Control queue needs patched interpreter, call AmiCtl.patch() "
+                               "first thing in your program or pass ctl=False.")
+        if ctl is None:
+            ctl = patched
+            if not ctl:
+                self.ctllog.critical("Interpreter is not patched, control queue is disabled.")
+        self._ctlq = CTLQueue('AMI_CTL', on_recv=[self._ctl_handler]) if ctl else None
         # Authorized controller IDs
         self.ctl_id_list = { self._ctl_id }
+        # ActionID allocator
+        self.ids = ActionID()
+        # Event handlers (see on)
+        self.handlers = AmiHandlers()
+        if self.parser is AmiCtl.parser:
+            self.parser = AmiReg(want=self._want)
+        # Connection supervision
+        if kw.get("reconnect") is not None:
+            self.reconnect = bool(kw.get("reconnect"))
+        self._supervise = False
+        self.reconnects = 0       # Successful reconnects
+        self.downtime = 0.        # Total seconds spent disconnected (after the first login)
+        self.down_since = None
 
 
     def reactor(self, recv):
         """
-        React, when data is received
+        React, when data is received. By default events are passed to the subscribed
+        handlers (see on), override it to handle the stream yourself.
+        """
+        self.parser.feed(recv)
+        dispatch = self.handlers.dispatch
+        for event in self.parser.events:
+            dispatch(event)
+    reactor.dispatching = True
+
+
+    @property
+    def _want(self):
+        """
+        Event filter of the default parser: built-in reactors (marked 'dispatching') only
+        pass events to the handlers, so the ones nobody subscribed to are not parsed.
+        Overridden reactor gets all of them.
+        """
+        if getattr(self.reactor, "dispatching", False):
+            return self.handlers.wanted
+
+
+    def on(self, event, callback, **headers):
+        """
+        Subscribe callback to the event name (AmiHandlers.ANY for all), see AmiHandlers.on.
+        Return the subscription token for 'off'.
+        """
+        return self.handlers.on(event, callback, **headers)
+
+
+    def on_action(self, aid, callback, **headers):
+        """
+        Subscribe callback to the events carrying ActionID 'aid'.
+        """
+        return self.handlers.on_action(aid, callback, **headers)
+
+
+    def off(self, token):
+        """
+        Cancel the subscription.
         """
+        return self.handlers.off(token)
 
     @property
     def _id(self):
         """
-        Use iso8601 datetime as internal ID
+        Allocate new internal (Action) ID
         """
-        return datetime.now().isoformat()
+        return self.ids.new()
 
 
     def login(self):
         """
-        Log in to the server.
+        Log in to the server and serve the connection (blocks until logoff).
+        When the connection drops, reconnect with jittered exponential backoff
+        (see AmiSocket.backoff) and log in again, unless reconnect is disabled.
         """
         # Reconnect on every attempt to login
         self.logoff()
-        # Init socket
-        self.soc.connect()
-        # Init login cmd keyword arguments
-        action_kw = {"Username"    : "{usr}".format(usr=self.usr),
-                     "Secret"      : "{pwd}".format(pwd=self.pwd),}
-        # Send login command
-        self.cmd("Login", **action_kw)
-        # Start I/O workers + logger
-        self._startIO()
+        self._supervise = True
+        attempt = 0
+        while self._supervise:
+            # Init socket
+            self.soc.connect()
+            if not self._supervise:
+                # Logged off while connecting
+                if self.soc.connected:
+                    self.soc.close()
+                break
+            if not self.soc.connected and self.reconnect:
+                gevent.sleep(self.soc.backoff(attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            # Init login cmd keyword arguments
+            action_kw = {"Username"    : "{usr}".format(usr=self.usr),
+                         "Secret"      : "{pwd}".format(pwd=self.pwd),}
+            # Send login command
+            self.cmd("Login", **action_kw)
+            if self.down_since is not None:
+                self.downtime += time() - self.down_since
+                self.down_since = None
+                self.reconnects += 1
+                log_msg = "Reconnected (%s reconnects, %.3f sec downtime): %s"
+                self.ctllog.critical(log_msg, self.reconnects, self.downtime, Stamp())
+                self.log.warning(log_msg, self.reconnects, self.downtime, Stamp())
+                self._reconnected()
+            # Start I/O workers + logger, returns when connection is gone
+            self._startIO()
+            if not (self._supervise and self.reconnect):
+                break
+            self.down_since = time()
+            self._disconnected()
+
+
+    @property
+    def conn_stats(self):
+        """
+        Connection statistics.
+        """
+        down = time() - self.down_since if self.down_since is not None else 0.
+        return dict(connected=self.soc.connected, reconnects=self.reconnects,
+                    downtime=self.downtime + down, down_for=down)
+
+
+    def _disconnected(self):
+        """
+        Called when connection dropped (before reconnecting).
+        """
+        # Commands queued for the dead connection are not sent to the new one
+        while not self._outq.empty():
+            self._outq.get_nowait()
+
+
+    def _reconnected(self):
+        """
+        Called when connection is re-established and login command is sent.
+        """
 
 
     def logoff(self):
         """
         Log off from the server.
         """
+        self._supervise = False
         if self.soc.connected:
             # Send logoff command
             self.cmd("Logoff")
@@ -133,13 +282,30 @@ class AmiCtl(object):
         Read from the socket and push events to the reactor.
         """
         self.ctllog.critical("Spawned _soc_reader")
+        # Received payloads are logged at the error level
+        logged = will_log(self.log, logging.ERROR)
         while self.soc.connected:
-            sleep(self.timeout)
-            recv = self.soc.recv()
+            # Blocks (yielding to other greenlets) until data arrives
+            try:
+                recv = self.soc.recv_into() if self.soc.zerocopy else self.soc.recv()
+            except socket.error as e:
+                log_msg = "Connection lost: %s\n%s"
+                self.ctllog.critical(log_msg, Stamp(), e)
+                self.log.warning(log_msg, Stamp(), e)
+                recv = (0, None)
+            if not recv or recv[0] == 0:
+                # Peer closed the connection
+                self.soc.close()
+                break
             self.reactor(recv[1])
+            if not logged:
+                continue
+            # recv[1] is a memoryview in zerocopy mode, valid only until the next recv
+            data = recv[1].tobytes() if self.soc.zerocopy else recv[1]
+            if self.sampler:
+                data = self.sampler(data)
             log_msg = "[ Received from AMI %4s bytes -- %s ]:\n%s"
-            self.log.error(log_msg, recv[0], self._id, recv[1])
-            if recv[0]==0: soc.close()
+            self.log.error(log_msg, len(data), Stamp(), data)
 
 
     def _soc_writer(self, soc=None):
@@ -147,14 +313,47 @@ class AmiCtl(object):
         Write to the socket.
         """
         self.ctllog.critical("Spawned _soc_writer")
-        #if not self.connected: return
+        outq = self._outq
         while self.soc.connected:
-            sleep(self.timeout)
-            if not self._outq.empty():
-                msg = self._outq.get_nowait()
-                log_msg = "[ Sending to AMI %4s bytes -- %s ]:\n%s"
-                self.log.error(log_msg, len(msg), self._id, msg)
+            # Wake up only when there is something to send
+            batch = [outq.get()]
+            size = len(batch[0])
+            # Coalesce queued commands (waiting up to flush_delay for more)
+            deadline = time() + self.flush_delay
+            while size < self.flush_size:
+                wait = deadline - time()
+                try:
+                    nxt = outq.peek(timeout=wait) if wait > 0 else outq.peek_nowait()
+                except Empty:
+                    break
+                if size + len(nxt) > self.flush_size: break
+                batch.append(outq.get_nowait())
+                size += len(nxt)
+            if not self.soc.connected: break
+            msg = "".join(batch)
+            self._flushed(len(batch), size)
+            log_msg = "[ Sending to AMI %4s bytes (%s commands) -- %s ]:\n%s"
+            self.log.error(log_msg, size, len(batch), Stamp(), msg)
+            try:
                 self.soc.send(msg)
+            except socket.error as e:
+                log_msg = "Connection lost: %s\n%s"
+                self.ctllog.critical(log_msg, Stamp(), e)
+                self.log.warning(log_msg, Stamp(), e)
+                self.soc.close()
+                break
+
+
+    def _flushed(self, commands, size):
+        """
+        Update write statistics.
+        """
+        stats = self.wstats
+        stats["flushes"] += 1
+        stats["commands"] += commands
+        stats["bytes"] += size
+        stats["last_commands"] = commands
+        stats["last_bytes"] = size
 
 
     def _ctl_handler(self, body, message):
@@ -182,7 +381,20 @@ class AmiCtl(object):
         assert type(a) is ListType, "ctl_handler received command args list which is not a ListType: %r" % a
         assert type(kw) is DictType, "ctl_handler received command keyword args dict which is not a DictType: %r" % kw
         if hasattr(self, command):
-            getattr(self, command)(*a, **kw)
+            result = getattr(self, command)(*a, **kw)
+            # Commands returning future result report it when it's ready
+            if hasattr(result, "rawlink"):
+                result.rawlink(self._ctl_result)
+
+
+    def _ctl_result(self, result):
+        """
+        Log result of the command requested via control queue.
+        """
+        value = result.value if result.successful() else result.exception
+        log_msg = "[cid: %s] - [result: %s]"
+        self.ctllog.critical(log_msg, getattr(result, "cid", None), value)
+        self.log.warning(log_msg, getattr(result, "cid", None), value)
 
 
     def _ctl_dispatch(self):
@@ -191,7 +403,7 @@ class AmiCtl(object):
         """
         self.ctllog.critical("Spawned _ctl_dispatch")
         while self.soc.connected:
-            sleep(self.timeout)
+            # Blocks until control message is received
             self._ctlq.drain()
 
 
@@ -205,65 +417,70 @@ class AmiCtl(object):
         if not action or not isinstance(action, str) :
             raise ValueError("<_build_command> Err: Action must be 'str' type")
 
-        command = []
+        spec = self._actions.get(action)
+        if spec is None:
+            spec = self._actions[action] = AmiAction(action)
         id = self._id      # Set Internal Command ID
-        nl = self.nl       # Define new line terminator
-
-        # Deal with action arg
-        command.append( "Action: {action}".format(action=action) )
-        command.append( "ActionID: {id}".format(id=id))
-
-        # Deal with optional keyword arguments
-        if kw:
-            for arg, value in kw.iteritems():
-                command.append( "{arg}: {value}".format(arg=arg, value=value))
-
-        # Double nl at the end is required to submit AMI command
-        final_command = nl.join(command) + nl*2
 
         # Also return internal ID with the final command
-        return (id, final_command)
+        return (id, spec.serialize(id, kw))
 
 
-    def cmd(self, action=None, **kw):
+    def _send(self, command):
         """
-        Send AMI command to the server.
+        Queue serialized AMI command for sending.
         """
-        id, command = self._command(action=action, **kw)
         if self.soc.connected:
             self._outq.put(command)
         else:
             raise IOError("<cmd> Err: Socket is dead!")
+
+
+    def cmd(self, action=None, **kw):
+        """
+        Send AMI command to the server.
+        """
+        id, command = self._command(action=action, **kw)
+        self._send(command)
         return id
 
 
     def _startIO(self, *a, **kw):
-        """Start I/O workers + logger"""
+        """Start I/O workers + logger, return when any of them exits (eg. connection dropped)"""
+        workers = []
         try:
-            r = gevent.spawn(self._soc_reader)
-            w = gevent.spawn(self._soc_writer)
-            ctl = gevent.spawn(self._ctl_dispatch)
-            gevent.joinall([r, w, ctl])
+            workers.extend([ gevent.spawn(self._soc_reader), gevent.spawn(self._soc_writer) ])
+            if self._ctlq is not None:
+                workers.append(gevent.spawn(self._ctl_dispatch))
+            gevent.wait(workers, count=1)
         except KeyboardInterrupt:
             log_msg = "Killing I/O workers softly: %s"
-            self.ctllog.critical(log_msg, self._id)
-            self.log.warning(log_msg, self._id)
+            self.ctllog.critical(log_msg, Stamp())
+            self.log.warning(log_msg, Stamp())
+            self._supervise = False
         except Exception as e:
             log_msg = "Something bad happened: %s\n%s"
-            self.ctllog.critical(log_msg, self._id, e)
-            self.log.warning(log_msg, self._id, e)
+            self.ctllog.critical(log_msg, Stamp(), e)
+            self.log.warning(log_msg, Stamp(), e)
+            self._supervise = False
         finally:
-            gevent.killall([r, w, ctl])
-            self.logoff()
+            gevent.killall(workers)
+            # Connection still alive means we are stopping, not reconnecting
+            if self.soc.connected:
+                self.logoff()
 
 
     def _set_logging(self):
         """
         Initialise loggers.
         """
-        name = LOG_NAME
+        name = self.log_name
         log_type = self.log_cfg.get("type")
         path = self.log_cfg.get("path") or "./"
+        # Ring buffer for the file logger: True or dict of AmiRing options (size, interval)
+        ring = self.log_cfg.get("ring")
+        # Per event type sampling of the logged payloads: {event name: log every Nth}
+        sample = self.log_cfg.get("sample")
 
         # Destination to severity level map
         # Messages which are less severe than lvl will be ignored (CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET)
@@ -272,6 +489,16 @@ class AmiCtl(object):
         log = logging.getLogger(name)
         ctllog = logging.getLogger(name + "-CTL")
 
+        # Loggers are global, so drop handlers added by the previous call
+        for logger in (log, ctllog):
+            for handler in [ h for h in logger.handlers if getattr(h, "amipal", False) ]:
+                logger.removeHandler(handler)
+                handler.close()
+
+        def add_handler(logger, handler):
+            handler.amipal = True
+            logger.addHandler(handler)
+
         # The level set in the 'root' logger determines which severity of messages it will pass to its handlers.
         # The level set in each handler determines which messages that handler will send on.
         ctllog.setLevel(lvl["ctl"])
@@ -282,7 +509,7 @@ class AmiCtl(object):
         handler = logging.StreamHandler()
         handler.setLevel(lvl["ctl"])
         handler.setFormatter(fmt)
-        ctllog.addHandler(handler)
+        add_handler(ctllog, handler)
         ctllog.critical("Done setting up Control Logger.")
 
         self.ctllog = ctllog
@@ -296,7 +523,7 @@ class AmiCtl(object):
             handler = logging.StreamHandler()
             handler.setLevel(lvl["console"])
             handler.setFormatter(fmt)
-            log.addHandler(handler)
+            add_handler(log, handler)
         def set_file():
             ctllog.critical("Spawned file logger")
             file_path = path + name + ".log"
@@ -304,7 +531,12 @@ class AmiCtl(object):
             handler = logging.FileHandler(filename=file_path, mode="a", delay=0)
             handler.setLevel(lvl["file"])
             handler.setFormatter(fmt)
-            log.addHandler(handler)
+            if ring:
+                ctllog.critical("Spawned ring buffer for file logger")
+                handler = AmiRing(handler, **(ring if isinstance(ring, DictType) else {}))
+            add_handler(log, handler)
+
+        self.sampler = AmiSample(sample) if sample else None
 
         if log_type in [0, "console"]:
             set_console()
@@ -322,14 +554,29 @@ class AmiSocket(object):
     soc = None
     soc_ERR = None
     connected = False
+    # Number of small reads in a row after which receive buffer is shrunk
+    shrink_after = 16
+    # Reconnect backoff: first delay and upper limit (seconds)
+    retry_base = .5
+    retry_max = 30.
 
 
-    def __init__(self, host="127.0.0.1", port=5038, buff=4096):
+    def __init__(self, host="127.0.0.1", port=5038, buff=4096, max_buff=262144, zerocopy=False,
+                 log_name=LOG_NAME):
+        """
+        - buff: Initial receive buffer size, it grows up to max_buff on bursts and
+          shrinks back to buff when traffic calms down.
+        - zerocopy: Receive into a reusable buffer (see recv_into).
+        """
         self.host = str(host)
         self.port = int(port)
-        self.buffer = int(buff)
-        self.log = logging.getLogger(LOG_NAME)
-        self.ctllog = logging.getLogger(CTL_LOG)
+        self.buffer = self.min_buffer = int(buff)
+        self.max_buffer = max(int(max_buff), self.buffer)
+        self.zerocopy = bool(zerocopy)
+        self._small = 0
+        self._rbuf, self._rview = None, None
+        self.log = logging.getLogger(log_name)
+        self.ctllog = logging.getLogger(log_name + "-CTL")
 
 
     def connect(self):
@@ -374,7 +621,10 @@ class AmiSocket(object):
             log_msg = "Terminating connection: %s:%s"
             self.ctllog.critical(log_msg, self.host, self.port)
             self.log.warning(log_msg, self.host, self.port)
-            self.soc.shutdown(socket.SHUT_RDWR)
+            try:
+                self.soc.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # Peer is already gone
             self.soc.close()
             self.soc = None
             self.connected = False
@@ -385,12 +635,53 @@ class AmiSocket(object):
             self.ctllog.critical(log_msg, self.host, self.port)
 
 
+    def backoff(self, attempt):
+        """
+        Delay (seconds) before the reconnect 'attempt' (0 based): exponential backoff
+        with random jitter, so many clients don't reconnect all at once.
+        """
+        delay = min(self.retry_base * 2 ** min(attempt, 32), self.retry_max)
+        return random.uniform(delay / 2, delay)
+
+
+    def _adapt(self, size):
+        """
+        Grow receive buffer when it was filled up, shrink it after a run of small reads.
+        """
+        if size >= self.buffer:
+            self._small = 0
+            self.buffer = min(self.buffer * 2, self.max_buffer)
+        elif size < self.buffer // 4 and self.buffer > self.min_buffer:
+            self._small += 1
+            if self._small >= self.shrink_after:
+                self._small = 0
+                self.buffer = max(self.buffer // 2, self.min_buffer)
+        else:
+            self._small = 0
+
+
     def recv(self):
         if self.connected:
             recv = self.soc.recv(self.buffer)
+            self._adapt(len(recv))
             return len(recv), recv
 
 
+    def recv_into(self):
+        """
+        Receive into the reusable buffer and return (size, memoryview) tuple.
+        The memoryview is overwritten by the next call, so consume (feed) it straight away.
+        """
+        if self.connected:
+            if self._rbuf is None or len(self._rbuf) != self.buffer:
+                self._rbuf = bytearray(self.buffer)
+                self._rview = memoryview(self._rbuf)
+            size = self.soc.recv_into(self._rview, self.buffer)
+            recv = self._rview[:size]
+            self._adapt(size)
+            return size, recv
+
+
     def send(self, msg):
         if self.connected:
             self.soc.sendall(msg)
@@ -482,6 +773,7 @@ class CTLQueue(object):
 
 
 if __name__ == "__main__":
+    patch()
     host = "127.0.0.2"
     port = 5038
     usr = "ami"
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Multi-server Hub
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import gevent
+from gevent.queue import Queue, Full
+
+# AMI built-in Commands
+from AmiCmd import AmiCmd
+from AmiCtl import LOG_NAME
+# Event handler registry
+from AmiReg import AmiHandlers
+
+
+class AmiTap(object):
+    """
+    AmiCmd listener passing node's events to the hub.
+    """
+    __slots__ = ("name", "hub")
+
+    def __init__(self, name, hub):
+        self.name = name
+        self.hub = hub
+
+    def onEvent(self, event):
+        self.hub.onEvent(self.name, event)
+
+
+class AmiHub(object):
+    """
+    Ami Multi-server Hub.
+    """
+    # Merged event stream size, events are dropped (and counted) when it is full
+    window = 10000
+
+    def __init__(self, nodes, cls=AmiCmd, **kw):
+        """
+        Drive many Asterisk servers from one process: every node is a separate
+        controller (own socket, parser state and reconnect loop) served by a greenlet.
+        Every node logs to its own logger and file named "AmiPAL-<node name>" (unless
+        node's log_name says otherwise), so each log holds the payloads of a single
+        server and can be replayed with AmiLog.
+        - nodes: Dict of node name -> controller keyword arguments (host, port, usr, pwd...).
+        - cls: Controller class (AmiCmd or its subclass).
+        - events: Event names merged into the stream (default: all events and responses),
+          the rest are dropped by the nodes before being parsed.
+        - kw: Keyword arguments common to all nodes (node ones take precedence).
+        """
+        self.window = int(kw.pop("window", self.window))
+        events = kw.pop("events", None) or [AmiHandlers.ANY]
+        self.events = Queue(self.window)  # Merged stream of (node name, AmiEvent)
+        self.dropped = 0
+        self.nodes = {}
+        self._serving = {}
+        for name, node_kw in nodes.iteritems():
+            args = dict(kw, ctl=False, log_name="%s-%s" % (LOG_NAME, name))
+            args.update(node_kw)
+            node = cls(**args)
+            tap = AmiTap(name, self)
+            for event in events:
+                node.on(event, tap.onEvent)
+            self.nodes[name] = node
+
+    def __iter__(self):
+        """
+        Iterate merged (node name, AmiEvent) stream, blocks waiting for events.
+        """
+        while True:
+            yield self.events.get()
+
+    def onEvent(self, name, event):
+        """
+        Called for every event of every node. Override to attach your callback,
+        by default events are pushed to the merged stream.
+        """
+        try:
+            self.events.put_nowait((name, event))
+        except Full:
+            self.dropped += 1
+
+    ## - Connections - ##
+    def start(self):
+        """
+        Log in to all nodes (every one in its own greenlet).
+        """
+        for name, node in self.nodes.iteritems():
+            if name not in self._serving or self._serving[name].dead:
+                self._serving[name] = gevent.spawn(node.login)
+        return self
+
+    def stop(self):
+        """
+        Log off from all nodes.
+        """
+        for node in self.nodes.itervalues():
+            node.logoff()
+        gevent.joinall(self._serving.values(), timeout=5)
+
+    def join(self, timeout=None):
+        gevent.joinall(self._serving.values(), timeout=timeout)
+
+    def serve(self):
+        """
+        Start and block until all nodes are logged off.
+        """
+        self.start().join()
+
+    @property
+    def stats(self):
+        """
+        Per node connection and pending command statistics.
+        """
+        stats = {}
+        for name, node in self.nodes.iteritems():
+            stats[name] = dict(node.conn_stats, **node.pending_stats)
+        return dict(nodes=stats, queued=self.events.qsize(), dropped=self.dropped)
+
+    ## - Fan-out commands - ##
+    def call(self, action, *a, **kw):
+        """
+        Send the command to every connected node, return dict of node name -> AmiResult.
+        - nodes: Names of the nodes to address (default: all of them).
+        """
+        names = kw.pop("nodes", None) or self.nodes.keys()
+        results = {}
+        for name in names:
+            result = getattr(self.nodes[name], action)(*a, **dict(kw))
+            if result is not None:
+                results[name] = result
+        return results
+
+    def gather(self, action, *a, **kw):
+        """
+        Fan-out the command and wait for all the answers (at most 'timeout' seconds).
+        Return dict of node name -> response (list of rows for the list commands),
+        failed and unanswered commands are represented by their exception / None.
+        """
+        timeout = kw.pop("timeout", None)
+        results = self.call(action, *a, **kw)
+        values = AmiCmd.gather(results.values(), timeout=timeout)
+        return dict(zip(results.keys(), values))
+
+    def collect(self, action, *a, **kw):
+        """
+        Fan-out the list command (eg. 'CoreShowChannels') and merge the rows of all
+        nodes into one list of (node name, AmiEvent) tuples. Failed nodes are skipped.
+        """
+        kw["stream"] = False
+        rows = []
+        for name, value in sorted(self.gather(action, *a, **kw).iteritems()):
+            if isinstance(value, list):
+                rows.extend((name, row) for row in value)
+        return rows
@@ -0,0 +1,300 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Log Utilities
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import logging, mmap, os, threading
+from collections import deque, Counter
+from datetime import datetime
+from time import time
+
+# Main Ami event registry class
+from AmiReg import AmiReg
+
+
+# Payload block header, as written by AmiCtl._soc_reader:
+# "[ Received from AMI %4s bytes -- %s ]:\n" followed by the raw payload
+RECV_MARK = "[ Received from AMI "
+RECV_SIZE = " bytes -- "
+RECV_END = " ]:\n"
+
+
+def iso(value):
+    """
+    Cast iso8601 string (as produced by datetime.isoformat) to datetime.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in value else "%Y-%m-%dT%H:%M:%S"
+    return datetime.strptime(value, fmt)
+
+
+def will_log(logger, level):
+    """
+    Return True if a record of the 'level' sent to the 'logger' would reach any handler,
+    so expensive log arguments are only built when they are written.
+    """
+    if not logger.isEnabledFor(level):
+        return False
+    while logger:
+        if any(level >= h.level for h in logger.handlers):
+            return True
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return False
+
+
+class AmiLog(object):
+    """
+    Ami Log Reader.
+    """
+    term = "\r\n\r\n"   # Event terminator (x2 nl)
+
+    def __init__(self, path="./AmiPAL.log", max_event=1048576):
+        """
+        Replay Ami payloads stored in the AmiPAL log file. The file is memory-mapped,
+        so it is never loaded into memory as a whole.
+        """
+        self.path = str(path)
+        self.max_event = max_event
+
+    def _blocks(self, mm, end=None):
+        """
+        Generator of (datetime, payload offset, payload size) of every received payload block.
+        """
+        pos = mm.find(RECV_MARK)
+        while pos != -1:
+            head_end = mm.find(RECV_END, pos)
+            if head_end == -1: break
+            size, _, ts = mm[pos + len(RECV_MARK):head_end].partition(RECV_SIZE)
+            try:
+                size, ts = int(size), iso(ts.strip())
+            except ValueError:
+                # Not a payload header, keep looking
+                pos = mm.find(RECV_MARK, head_end)
+                continue
+            # Log is written in chronological order
+            if end and ts > end: break
+            offset = head_end + len(RECV_END)
+            yield ts, offset, size
+            pos = mm.find(RECV_MARK, offset + size)
+
+    def payloads(self, start=None, end=None):
+        """
+        Generator of (datetime, raw payload) tuples received from the AMI.
+        - start, end: Optional datetime (or iso8601 string) range of the payloads.
+        The payload which follows skipped ones is trimmed to the first event boundary,
+        so it never starts in the middle of an event.
+        """
+        start, end = iso(start), iso(end)
+        term = self.term
+        with open(self.path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                aligned = True
+                for ts, offset, size in self._blocks(mm, end=end):
+                    if not size: continue
+                    if start and ts < start:
+                        aligned = mm[offset + size - len(term):offset + size] == term
+                        continue
+                    if not aligned:
+                        aligned = True
+                        cut = mm.find(term, offset, offset + size)
+                        if cut == -1: continue
+                        size -= cut + len(term) - offset
+                        offset = cut + len(term)
+                        if not size: continue
+                    yield ts, mm[offset:offset + size]
+            finally:
+                mm.close()
+
+    def events(self, start=None, end=None, events=None, deny=None):
+        """
+        Generator of AmiEvent objects parsed from the log.
+        - start, end: Optional datetime (or iso8601 string) range of the payloads.
+        - events: If set, only these event names are parsed (responses are always parsed).
+        - deny: Event names which are dropped before being parsed.
+        """
+        reg = AmiReg(max_event=self.max_event, deny=deny, allow=events)
+        for ts, data in self.payloads(start=start, end=end):
+            reg.feed(data)
+            for event in reg.events:
+                yield event
+
+
+class Stamp(object):
+    """
+    Log timestamp, only formatted (iso8601) when the log record is.
+    """
+    __slots__ = ("t",)
+
+    def __init__(self, t=None):
+        self.t = time() if t is None else t
+
+    def __str__(self):
+        return datetime.fromtimestamp(self.t).isoformat()
+
+
+class AmiSample(object):
+    """
+    Per event type payload sampler.
+    """
+    term = "\r\n\r\n"   # Event terminator (x2 nl)
+
+    def __init__(self, rates):
+        """
+        Remove events from the raw payloads before they are logged.
+        - rates: Event name -> N dict, only every Nth event of the type is kept (0 drops them all).
+        Events which are split between payloads are always kept, so logged stream stays parsable.
+        """
+        self.rates = dict(rates)
+        self.seen = Counter()
+        self.dropped = Counter()
+        self._aligned = True  # Previous payload ended on the event boundary
+
+    def _keep(self, chunk):
+        name = AmiReg.event_name(chunk)
+        rate = self.rates.get(name)
+        if rate is None:
+            return True
+        self.seen[name] += 1
+        if rate and (self.seen[name] - 1) % rate == 0:
+            return True
+        self.dropped[name] += 1
+        return False
+
+    def __call__(self, payload):
+        """
+        Return payload without the sampled out events.
+        """
+        term = self.term
+        parts = payload.split(term)
+        last = len(parts) - 1
+        out = []
+        for i, part in enumerate(parts):
+            if i == last:
+                out.append(part)
+            elif (i or self._aligned) and part and not self._keep(part):
+                continue
+            else:
+                out.append(part + term)
+        self._aligned = not parts[last]
+        return "".join(out)
+
+
+class AmiRing(logging.Handler):
+    """
+    Ring buffer log handler.
+    """
+
+    def __init__(self, target, size=10000, interval=.5):
+        """
+        Push log records into the bounded in-memory ring buffer, background writer
+        passes them to the 'target' handler in batches every 'interval' seconds.
+        Logging call never blocks: when the ring is full the oldest record is dropped.
+        """
+        logging.Handler.__init__(self, level=target.level)
+        self.target = target
+        self.interval = float(interval)
+        self.dropped = 0
+        self.written = 0
+        self._ring = deque(maxlen=int(size))
+        self._closed = False
+        # Looked up now, not on import: after gevent patching both the writer thread and
+        # the event are cooperative, a blocking sleep would freeze the whole process
+        self._wake = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name="AmiRing")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, record):
+        ring = self._ring
+        if len(ring) == ring.maxlen:
+            self.dropped += 1
+        ring.append(record)
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered records to the target with a single write.
+        """
+        ring, target = self._ring, self.target
+        records = []
+        while ring:
+            record = ring.popleft()
+            if record.levelno >= target.level and target.filter(record):
+                records.append(record)
+        if not records:
+            return
+        if isinstance(target, logging.StreamHandler):
+            target.acquire()
+            try:
+                if target.stream is None:
+                    target.stream = target._open()
+                target.stream.write("".join(target.format(r) + "\n" for r in records))
+                target.flush()
+            finally:
+                target.release()
+        else:
+            for record in records:
+                target.handle(record)
+        self.written += len(records)
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        # Let the writer finish before interpreter shutdown tears the modules down
+        if self._writer is not threading.current_thread():
+            self._writer.join(self.interval + 1)
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Count events stored in the AmiPAL log file.")
+    ap.add_argument("path", help="AmiPAL log file.")
+    ap.add_argument("--start", help="iso8601 start time.")
+    ap.add_argument("--end", help="iso8601 end time.")
+    ap.add_argument("--events", nargs="+", help="Event names to select.")
+    opts = ap.parse_args()
+
+    counts = Counter(event.get("Event") or event.get("Response")
+                     for event in AmiLog(opts.path).events(opts.start, opts.end, opts.events))
+    for name, count in counts.most_common():
+        print "%8d %s" % (count, name)
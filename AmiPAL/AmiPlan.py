@@ -0,0 +1,152 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Dialplan Snapshot
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import json
+from time import time
+
+
+class AmiPlan(object):
+    """
+    Indexed dialplan snapshot.
+    """
+    # ListDialplan headers stored for every priority
+    fields = ("Application", "AppData", "ExtensionLabel", "Registrar")
+
+    def __init__(self):
+        """
+        Dialplan as {context: {extension: {priority: {field: value}}}}, built from the
+        'ShowDialPlan' response rows. Contexts can be refreshed one by one (see update).
+        """
+        self._plan = {}        # Context -> extension -> priority -> fields
+        self._includes = {}    # Context -> list of included contexts
+        self.updated = {}      # Context -> epoch seconds of the last refresh
+
+    def __len__(self):
+        return len(self._plan)
+
+    def __contains__(self, context):
+        return context in self._plan
+
+    @staticmethod
+    def _priority(value):
+        """
+        Numeric priorities as int, the rest (eg. 'hint') as is.
+        """
+        return int(value) if value.isdigit() else value
+
+    @property
+    def contexts(self):
+        return sorted(self._plan)
+
+    def extensions(self, context):
+        """
+        Return {extension: {priority: fields}} of the context (empty, if unknown).
+        """
+        return self._plan.get(context, {})
+
+    def priorities(self, context, extension):
+        return self._plan.get(context, {}).get(extension, {})
+
+    def lookup(self, context, extension, priority=1):
+        """
+        Return fields dict of the dialplan step or None.
+        """
+        return self.priorities(context, extension).get(self._priority(str(priority)))
+
+    def includes(self, context):
+        return self._includes.get(context, [])
+
+    def update(self, rows, context=None):
+        """
+        Index 'ShowDialPlan' response rows (list of ListDialplan AmiEvents).
+        Contexts present in the rows replace their old copies. The full dialplan
+        (context=None) replaces the whole snapshot, otherwise only 'context' is refreshed.
+        """
+        plan, includes = {}, {}
+        for row in rows:
+            ctx = row.get("Context")
+            if not ctx:
+                continue
+            exts = plan.setdefault(ctx, {})
+            include = row.get("IncludeContext")
+            if include:
+                includes.setdefault(ctx, []).append(include)
+                continue
+            ext, pri = row.get("Extension"), row.get("Priority")
+            if ext is None or pri is None:
+                continue
+            exts.setdefault(ext, {})[self._priority(pri)] = \
+                { k: row.get(k) for k in self.fields if row.get(k) is not None }
+        if context is None:
+            self._plan, self._includes, self.updated = {}, {}, {}
+        else:
+            self.drop(context)
+        now = time()
+        for ctx, exts in plan.iteritems():
+            self._plan[ctx] = exts
+            self._includes[ctx] = includes.get(ctx, [])
+            self.updated[ctx] = now
+
+    def drop(self, context):
+        """
+        Forget the context (eg. it was removed from the dialplan).
+        """
+        self._plan.pop(context, None)
+        self._includes.pop(context, None)
+        self.updated.pop(context, None)
+
+    ## - Persistence - ##
+    def save(self, path):
+        """
+        Store snapshot as JSON.
+        """
+        data = dict(plan=self._plan, includes=self._includes, updated=self.updated)
+        with open(path, "w") as f:
+            json.dump(data, f, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load snapshot stored with 'save'.
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+        plan = cls()
+        # JSON gives unicode strings and string keys, restore str and numeric priorities
+        enc = lambda x: x.encode("utf-8") if isinstance(x, unicode) else x
+        plan._plan = { enc(ctx): { enc(ext): { cls._priority(enc(pri)): { enc(k): enc(v) for k, v in step.iteritems() }
+                                               for pri, step in pris.iteritems() }
+                                   for ext, pris in exts.iteritems() }
+                       for ctx, exts in data.get("plan", {}).iteritems() }
+        plan._includes = { enc(k): [ enc(x) for x in v ] for k, v in data.get("includes", {}).iteritems() }
+        plan.updated = { enc(k): v for k, v in data.get("updated", {}).iteritems() }
+        return plan
@@ -0,0 +1,231 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+# Ami Multi-core Parse / Dispatch Pool
+
+## Part of the AmiPAL project ~:~ https://github.com/narunask/AmiPAL
+
+Redistribution and use in source and binary forms, with or without modification, are permitted
+provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of conditions
+   and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+   conditions and the following disclaimer in the documentation and/or other materials provided
+   with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used to
+   endorse or promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016 Narunas K. All rights reserved.
+"""
+
+import os, multiprocessing
+from time import time
+from gevent.os import nb_write, make_nonblocking
+
+# Main Ami event registry class
+from AmiReg import AmiReg
+
+
+def header(chunk, name):
+    """
+    Return 'name' header value of the raw Ami chunk without parsing it, or None.
+    """
+    if chunk.startswith(name + ":"):
+        pos = len(name) + 1
+    else:
+        pos = chunk.find("\r\n" + name + ":")
+        if pos == -1: return None
+        pos += len(name) + 3
+    end = chunk.find("\r\n", pos)
+    return (chunk[pos:] if end == -1 else chunk[pos:end]).strip()
+
+
+def _work(rfd, wfds, handler, done, deny, allow, max_event):
+    """
+    Worker process: parse the Ami stream from the pipe and call handler for every event.
+    """
+    # Inherited write ends would keep the pipes open after the pool is closed
+    for fd in wfds:
+        os.close(fd)
+    reg = AmiReg(max_event=max_event, deny=deny, allow=allow)
+    processed = 0
+    while True:
+        data = os.read(rfd, 65536)
+        if not data:
+            break  # Pool closed
+        reg.feed(data)
+        for event in reg.events:
+            handler(event)
+            processed += 1
+        done.value = processed
+
+
+class AmiPool(object):
+    """
+    Ami Multi-core Parse / Dispatch Pool.
+    """
+    # Headers the events are sharded by (first one present wins)
+    keys = ("Linkedid", "Uniqueid")
+
+    def __init__(self, handler, workers=None, local=(), want=None, deny=None, allow=None,
+                 max_event=1048576):
+        """
+        Split Ami stream into raw events and ship them to 'workers' processes, which parse
+        them and call 'handler(event)'. Events are sharded by Linkedid / Uniqueid (or event
+        name, when neither is present), so events of the same call are handled in order by
+        the same worker. Asterisk 1.8/11 events carry no Linkedid, there the order is only
+        kept per channel (legs of a call may be handled by different workers).
+        Events carrying ActionID (command responses) are not shipped, they are returned
+        by feed to be parsed in process. Worker which dies is started again, events shipped
+        to it and not handled are counted as lost (see stats).
+        - handler: Function called with every AmiEvent in the worker process.
+        - workers: Number of processes (default: number of CPUs).
+        - local: Event names which are returned by feed as well (eg. for in process listeners).
+        - want: Callable (event name -> bool), the events it accepts are returned by feed
+          as well; AmiCmd sets it to its AmiHandlers.wanted, so in process subscriptions
+          keep receiving their events.
+        - deny, allow: Event name filters, see AmiReg.
+        """
+        self.handler = handler
+        self.size = int(workers or multiprocessing.cpu_count())
+        self.local = frozenset(local)
+        self.want = want
+        self._reg = AmiReg(max_event=max_event, deny=deny, allow=allow)
+        self._filters = (deny, allow, max_event)
+        self.sent = [0] * self.size      # Events shipped to every worker (since its start)
+        self.lost = [0] * self.size      # Events lost with the dead workers
+        self.restarts = [0] * self.size  # Times every worker was started again
+        self.started = time()
+        self._done = [None] * self.size
+        self._fds = [None] * self.size
+        self._procs = [None] * self.size
+        for i in range(self.size):
+            self._spawn(i)
+
+    def _spawn(self, i):
+        """
+        Start worker 'i' with a fresh pipe.
+        """
+        deny, allow, max_event = self._filters
+        rfd, wfd = os.pipe()
+        done = multiprocessing.Value("L", 0, lock=False)
+        fds = [ x for x in self._fds if x is not None ] + [wfd]
+        proc = multiprocessing.Process(target=_work, name="AmiPool-%d" % i,
+                                       args=(rfd, fds, self.handler, done,
+                                             deny, allow, max_event))
+        proc.daemon = True
+        proc.start()
+        os.close(rfd)
+        make_nonblocking(wfd)
+        self._done[i], self._fds[i], self._procs[i] = done, wfd, proc
+
+    def _restart(self, i):
+        """
+        Replace dead worker 'i', count the events it didn't handle as lost.
+        """
+        self.lost[i] += self.sent[i] - self._done[i].value
+        self.sent[i] = 0
+        self.restarts[i] += 1
+        os.close(self._fds[i])
+        self._fds[i] = None
+        proc = self._procs[i]
+        if proc.is_alive():
+            proc.terminate()
+        proc.join(1)
+        self._spawn(i)
+
+    @property
+    def buff(self):
+        """
+        Return underlying AmiBuff object.
+        """
+        return self._reg.buff
+
+    def shard(self, chunk):
+        """
+        Return index of the worker the raw Ami chunk belongs to.
+        """
+        for key in self.keys:
+            value = header(chunk, key)
+            if value:
+                return hash(value) % self.size
+        return hash(AmiReg.event_name(chunk)) % self.size
+
+    def feed(self, stream):
+        """
+        Collect Ami stream, ship complete events to the workers. Blocks (yielding to other
+        greenlets) while the workers are behind. Return list of raw chunks which are to be
+        handled in process (see AmiReg.parse).
+        """
+        reg, local, want, size = self._reg, self.local, self.want, self.size
+        batches = [ [] for _ in range(size) ]
+        keep = []
+        for chunk in reg.buff.feed(stream):
+            if not reg.wanted(chunk):
+                continue
+            if header(chunk, "ActionID") is not None:
+                keep.append(chunk)
+                continue
+            if local or want is not None:
+                name = AmiReg.event_name(chunk)
+                if name in local or (want is not None and want(name)):
+                    keep.append(chunk)
+            batches[self.shard(chunk)].append(chunk)
+        term = reg.buff.term
+        for i, batch in enumerate(batches):
+            if batch:
+                self.sent[i] += len(batch)
+                try:
+                    self._write(self._fds[i], term.join(batch) + term)
+                except (IOError, OSError):
+                    # Worker is gone (broken pipe), the batch is lost with it
+                    self._restart(i)
+        return keep
+
+    @staticmethod
+    def _write(fd, data):
+        while data:
+            data = data[nb_write(fd, data):]
+
+    def close(self, timeout=5):
+        """
+        Let workers finish queued events and stop them.
+        """
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+        for proc in self._procs:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+
+    @property
+    def depth(self):
+        """
+        Events shipped but not yet handled, per worker.
+        """
+        return [ sent - done.value for sent, done in zip(self.sent, self._done) ]
+
+    @property
+    def stats(self):
+        """
+        Per worker queue depth and throughput (handled events per second).
+        """
+        elapsed = max(time() - self.started, 1e-9)
+        return [ dict(worker=i, pid=proc.pid, alive=proc.is_alive(), sent=self.sent[i],
+                      done=done.value, depth=self.sent[i] - done.value,
+                      lost=self.lost[i], restarts=self.restarts[i],
+                      events_sec=done.value / elapsed)
+                 for i, (proc, done) in enumerate(zip(self._procs, self._done)) ]
@@ -30,9 +30,11 @@ ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF S
 Copyright (c) 2016 Narunas K. All rights reserved.
 """
 
+import logging
 from cStringIO import StringIO
 from collections import Sequence
 from collections import OrderedDict as od
+from collections import Counter
 
 
 class AmiLine(object):
@@ -135,19 +137,43 @@ class AmiLine(object):
         return None
 
 
-class AmiEvent(Sequence):
+class AmiEvent(object):
     """
     Ami Event Object.
     """
-    __slots__ = ("_event", "_extra")
+    # Sequence ABC is registered below, not inherited: it has no __slots__ in Python 2
+    __slots__ = ("_event", "_kv", "_extra", "_t", "_od")
 
     def __init__(self, event=""):
         """
         Cast Ami event view to the list of tuples, list of dicts or the ordered dict.
         Must be initialised with the AmiLine instances sequence.
+        Views are built once, on first access, and served from the cache afterwards.
         """
         self._event = self.validate(event)
 
+    @classmethod
+    def fromchunk(cls, chunk):
+        """
+        Create compact event from the raw Ami chunk (single event without terminator).
+        Attribute names are interned and stored together with values in one flat tuple,
+        AmiLine objects are only created if they are requested.
+        """
+        self = cls.__new__(cls)
+        kv = []
+        # Command output of the older Asterisk versions is terminated by bare "\n"
+        for line in chunk.splitlines():
+            if not line: continue
+            pair = line.split(':', 1)
+            attr = pair[0].strip()
+            val = pair[1].strip() if len(pair) == 2 else None
+            # Skip lines which AmiLine would evaluate to None
+            if not attr and not val: continue
+            kv.append(intern(attr))
+            kv.append(val)
+        self._kv = tuple(kv)
+        return self
+
     @staticmethod
     def validate(val):
         if not isinstance(val, Sequence):
@@ -158,14 +184,32 @@ class AmiEvent(Sequence):
 
     # Required sequence methods
     def __getitem__(self, index):
-        if hasattr(self, "_extra"):
-            return (self._event + self._extra)[index]
-        return self._event[index]
+        return self.lines[index]
 
     def __len__(self):
+        if hasattr(self, "_event"):
+            size = len(self._event)
+        else:
+            size = len(self._kv) // 2
         if hasattr(self, "_extra"):
-            return len(self._event + self._extra)
-        return len(self._event)
+            size += len(self._extra)
+        return size
+
+    # Sequence mixin methods
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __reversed__(self):
+        return reversed(self.lines)
+
+    def __contains__(self, value):
+        return value in self.lines
+
+    def index(self, value):
+        return self.lines.index(value)
+
+    def count(self, value):
+        return self.lines.count(value)
 
     ## - Custom methods - ##
     def __repr__(self):
@@ -173,37 +217,91 @@ class AmiEvent(Sequence):
 
     @property
     def e(self):
-        return self._event
+        """
+        Event AmiLines (created on demand for compact events).
+        """
+        try:
+            return self._event
+        except AttributeError:
+            kv = self._kv
+            self._event = tuple(AmiLine(attr if val is None else "%s: %s" % (attr, val))
+                                for attr, val in zip(kv[0::2], kv[1::2]))
+            return self._event
+
+    @property
+    def lines(self):
+        """
+        Event AmiLines including extra ones.
+        """
+        if hasattr(self, "_extra"):
+            return tuple(self.e) + tuple(self._extra)
+        return self.e
+
+    def _reset(self):
+        """
+        Invalidate cached views.
+        """
+        for attr in ("_t", "_od"):
+            if hasattr(self, attr): delattr(self, attr)
+
+    def get(self, key, default=None):
+        """
+        Return value of the event attribute (header) or default. The last one wins,
+        when the header is repeated. Compact events are scanned in place, no view is built.
+        """
+        value = default
+        if hasattr(self, "_kv"):
+            kv, i = self._kv, -1
+            while True:
+                try:
+                    i = kv.index(key, i + 1)
+                except ValueError:
+                    break
+                # Attributes are at the even offsets, values at the odd ones
+                if not i % 2: value = kv[i + 1]
+        else:
+            for pair in (line.t for line in self._event):
+                if pair and pair[0] == key: value = pair[1]
+        if hasattr(self, "_extra"):
+            for pair in (line.t for line in self._extra):
+                if pair and pair[0] == key: value = pair[1]
+        return value
 
     @property
     def t(self):
         """
         View Ami event as tuple of tuples.
         """
-        event = self._event
-        if hasattr(self, "_extra"):
-            event += self._extra
-        return tuple(line.t for line in event)
+        try:
+            return self._t
+        except AttributeError:
+            if hasattr(self, "_kv"):
+                kv = self._kv
+                t = tuple(zip(kv[0::2], kv[1::2]))
+            else:
+                t = tuple(line.t for line in self._event)
+            if hasattr(self, "_extra"):
+                t += tuple(line.t for line in self._extra)
+            self._t = t
+            return t
 
     @property
     def d(self):
         """
         View Ami event as tuple of dicts.
         """
-        event = self._event
-        if hasattr(self, "_extra"):
-            event += self._extra
-        return tuple(line.d for line in event)
+        return tuple({pair[0]: pair[1]} if pair else None for pair in self.t)
 
     @property
     def od(self):
         """
         View Ami event as ordered dict (most useful).
         """
-        event = self._event
-        if hasattr(self, "_extra"):
-            event += self._extra
-        return od(line.t for line in event)
+        try:
+            return self._od
+        except AttributeError:
+            self._od = od(pair for pair in self.t if pair)
+            return self._od
 
     @property
     def extra(self):
@@ -215,13 +313,17 @@ class AmiEvent(Sequence):
         return None
 
     @extra.setter
-    def set_extra(self, val=None):
+    def extra(self, val=None):
         self._extra = self.validate(val)
+        self._reset()
 
     @extra.deleter
-    def del_extra(self, val=None):
+    def extra(self):
         if hasattr(self, "_extra"):
             delattr(self, "_extra")
+            self._reset()
+
+Sequence.register(AmiEvent)
 
 
 class AmiStrm(object):
@@ -311,18 +413,122 @@ class AmiStrm(object):
         return ( AmiEvent(chunk) for chunk in self.chunks )
 
 
+class AmiBuff(object):
+    """
+    Ami Stream Buffer.
+    """
+    __slots__ = ("_buf", "_end", "_size", "_scan", "_skip", "max_event", "overflow", "peak")
+
+    # Event terminator (x2 nl)
+    term = "\r\n\r\n"
+
+    def __init__(self, max_event=1048576, size=8192):
+        """
+        Incremental Ami stream splitter. Collects raw stream into a single preallocated buffer
+        and only scans freshly received bytes for the event terminator.
+        - max_event: Maximum size (in bytes) of the incomplete event we are willing to hold.
+        - size: Initial buffer capacity.
+        """
+        self._size = int(size)
+        self._buf = bytearray(self._size)
+        self._end = 0         # Length of the valid data in the buffer
+        self._scan = 0        # Offset from where the next terminator lookup starts
+        self._skip = False    # Set while discarding an oversized event
+        self.max_event = int(max_event)
+        self.overflow = 0     # Number of oversized events which were discarded
+        self.peak = 0         # Most bytes held at once (before complete events were taken out)
+
+    def __len__(self):
+        return self._end
+
+    def _move(self, start):
+        """
+        Move data from 'start' to the front of the buffer.
+        """
+        buf, end = self._buf, self._end
+        buf[0:end - start] = buf[start:end]
+        self._end = end = end - start
+        # Give back memory taken by an unusually big event
+        if end <= self._size < len(buf) // 4:
+            del buf[self._size:]
+
+    def feed(self, stream):
+        """
+        Append stream (str, bytearray or memoryview) to the buffer and return the list of
+        complete raw chunks (without terminator). Every chunk is returned exactly once.
+        """
+        buf, term = self._buf, self.term
+        end, size = self._end, len(stream)
+        if end + size > len(buf):
+            buf.extend(bytearray(max(end + size, 2 * len(buf)) - len(buf)))
+        buf[end:end + size] = stream
+        self._end = end = end + size
+        if end > self.peak:
+            self.peak = end
+        chunks = []
+        start = 0
+        idx = buf.find(term, self._scan, end)
+        while idx != -1:
+            if self._skip:
+                # Throw away the rest of the oversized event
+                self._skip = False
+            elif idx > start:
+                # Event is materialised straight from the buffer
+                chunks.append(str(buffer(buf, start, idx - start)))
+            start = idx + len(term)
+            idx = buf.find(term, start, end)
+        if start:
+            self._move(start)
+        # Terminator might be split between two reads
+        self._scan = max(self._end - len(term) + 1, 0)
+        if self._skip or self._end > self.max_event:
+            # Malformed peer, do not let the tail grow without limit
+            if not self._skip:
+                self.overflow += 1
+                self._skip = True
+            self._move(self._scan)
+            self._scan = 0
+        return chunks
+
+    @property
+    def tail(self):
+        """
+        Return incomplete (not yet terminated) part of the stream or None.
+        """
+        if self._end and not self._skip:
+            return str(buffer(self._buf, 0, self._end))
+        return None
+
+    def clear(self):
+        """
+        Drop everything collected so far.
+        """
+        self._end = 0
+        self._scan = 0
+        self._skip = False
+
+
 class AmiReg(object):
     """
     Ami Event Registry.
     """
-    __slots__ = ("_tail", "_stream")
+    __slots__ = ("_buff", "_events", "deny", "allow", "want", "dropped")
 
-    def __init__(self):
+    def __init__(self, max_event=1048576, deny=None, allow=None, want=None):
         """
         Feed Ami text stream chunks to this object, override 'onEvent' method to attach a callback.
-        """
-        self._tail = None
-        self._stream = None # Temporary AmiStrm container
+        - max_event: Maximum size (in bytes) of the single Ami event.
+        - deny: Event names which are dropped before being parsed.
+        - allow: If set, only these event names are parsed (responses are always parsed).
+        - want: Callable (event name -> bool), events it rejects are dropped before being
+          parsed, unless they carry ActionID (eg. rows of the list commands), see AmiHandlers.
+        """
+        self._buff = AmiBuff(max_event=max_event)
+        self._events = [] # Events parsed during the latest feed
+        self.deny = frozenset(deny or ())
+        self.allow = frozenset(allow) if allow is not None else None
+        self.want = want
+        self.dropped = Counter() # Event name -> number of dropped events
 
     def onEvent(self, event):
         """
@@ -330,53 +536,215 @@ class AmiReg(object):
         """
         pass #print event.d
 
+    @staticmethod
+    def parse(chunk):
+        """
+        Cast raw Ami chunk (single event without terminator) to the AmiEvent object.
+        """
+        return AmiEvent.fromchunk(chunk)
+
+    @staticmethod
+    def event_name(chunk):
+        """
+        Return 'Event' header value of the raw Ami chunk without parsing the rest of it.
+        Return None if chunk has no such header (eg. it is a response).
+        """
+        if chunk.startswith("Event:"):
+            pos = 6
+        else:
+            pos = chunk.find("\r\nEvent:")
+            if pos == -1: return None
+            pos += 8
+        end = chunk.find("\r\n", pos)
+        if end == -1:
+            return chunk[pos:].strip()
+        return chunk[pos:end].strip()
+
+    def wanted(self, chunk):
+        """
+        Check raw Ami chunk against deny/allow lists, count the ones which are dropped.
+        """
+        want = self.want
+        if not self.deny and self.allow is None and want is None:
+            return True
+        name = self.event_name(chunk)
+        if name is None:
+            return True
+        if name in self.deny or (self.allow is not None and name not in self.allow):
+            self.dropped[name] += 1
+            return False
+        if want is not None and not want(name):
+            if chunk.startswith("ActionID:") or chunk.find("\r\nActionID:") != -1:
+                return True
+            self.dropped[name] += 1
+            return False
+        return True
+
     def feed(self, stream=None, id=None):
         """
         Collect Ami stream and parse it.
         """
-        if not stream or not isinstance(stream, str):
-            raise ValueError("Input is expected to be non empty string.")
-        if self._tail:
-            self._stream = AmiStrm(stream=stream, tail=self._tail)
-        else:
-            self._stream = AmiStrm(stream=stream)
-        # Update tail
-        self._tail = self.str.tail
+        if not stream or not isinstance(stream, (str, bytearray, memoryview)):
+            raise ValueError("Input is expected to be non empty string, bytearray or memoryview.")
+        parse = self.parse
+        wanted = self.wanted
+        self._events = events = []
+        for chunk in self._buff.feed(stream):
+            if not wanted(chunk):
+                continue
+            event = parse(chunk)
+            if event:
+                events.append(event)
         # Call onEvent for each event in the stream
-        for event in self.events:
+        for event in events:
             self.onEvent(event)
 
     @property
-    def str(self):
+    def buff(self):
         """
-        Return latest AmiStrm object.
+        Return underlying AmiBuff object.
         """
-        return self._stream
+        return self._buff
 
     @property
     def events(self):
         """
         Return parsed events generator in this stream chunk.
         """
-        return self.str.events
+        return iter(self._events)
 
     @property
     def tail(self):
         """
-        Return tail of the latest AmiStrm Object if any.
+        Return incomplete part of the stream if any.
         """
-        return self._tail
+        return self._buff.tail
 
 
+class AmiHandlers(object):
+    """
+    Ami Event Handler Registry.
+    """
+    ANY = "*"   # Subscribe to all events
+
+    def __init__(self):
+        """
+        Callbacks subscribe to event names or ActionIDs, optionally filtered by header values.
+        Dispatch is a single lookup in the table, rebuilt whenever subscriptions change.
+        Pass 'wanted' to AmiReg (want=...) to drop the events nobody subscribed to before
+        they are parsed.
+        """
+        self._events = {}     # Event name -> list of (predicates, callback)
+        self._actions = {}    # ActionID -> list of (predicates, callback)
+        self._table = {}      # Event name -> tuple of (predicates, callback), incl. ANY ones
+        self._any = ()        # ANY subscriptions
+        self.dispatched = 0                # Callback calls
+        self.unhandled = Counter()         # Event name -> parsed events no callback took
+        self.errors = Counter()            # Event name -> callback calls which raised
+        self.log = logging.getLogger("AmiPAL")
+
+    @staticmethod
+    def _compile(headers):
+        """
+        Header predicates as tuple of (header, value or test, is test callable).
+        """
+        return tuple((k, v, callable(v)) for k, v in headers.iteritems())
+
+    @staticmethod
+    def match(event, predicates):
+        get = event.get
+        for key, test, call in predicates:
+            value = get(key)
+            if call:
+                if not test(value): return False
+            elif value != test:
+                return False
+        return True
+
+    def _rebuild(self):
+        wild = tuple(self._events.get(self.ANY, ()))
+        self._any = wild
+        self._table = { name: tuple(subs) + wild for name, subs in self._events.iteritems()
+                        if name != self.ANY and subs }
+
+    def on(self, event, callback, **headers):
+        """
+        Call 'callback(event)' for every event named 'event' (ANY for all of them),
+        whose headers match all 'headers': value to compare or callable test, eg.
+        on("PeerStatus", cb, PeerStatus="Unreachable", Peer=lambda x: x.startswith("SIP/")).
+        Return the subscription token for 'off'.
+        """
+        entry = (self._compile(headers), callback)
+        self._events.setdefault(event, []).append(entry)
+        self._rebuild()
+        return (event, entry)
+
+    def on_action(self, aid, callback, **headers):
+        """
+        Call 'callback(event)' for every event carrying ActionID 'aid'. Return token for 'off'.
+        """
+        entry = (self._compile(headers), callback)
+        self._actions.setdefault(aid, []).append(entry)
+        return (aid, entry)
+
+    def off(self, token):
+        """
+        Cancel the subscription.
+        """
+        key, entry = token
+        for subs, rebuild in ((self._events, True), (self._actions, False)):
+            entries = subs.get(key)
+            if entries and any(x is entry for x in entries):
+                entries[:] = [ x for x in entries if x is not entry ]
+                if not entries:
+                    del subs[key]
+                if rebuild:
+                    self._rebuild()
+                return True
+        return False
+
+    def wanted(self, name):
+        """
+        Does anyone subscribe to the event name.
+        """
+        return name in self._table or bool(self._any)
+
+    def _call(self, callback, event, name):
+        """
+        Call the callback, failing one is logged and counted, so it can't stop the reader.
+        """
+        try:
+            callback(event)
+        except Exception:
+            self.errors[name] += 1
+            self.log.warning("Event handler %r failed on %s:", callback, name, exc_info=True)
+
+    def dispatch(self, event):
+        """
+        Pass the event to the subscribed callbacks, return number of calls.
+        """
+        name = event.get("Event")
+        match = self.match
+        calls = 0
+        for predicates, callback in self._table.get(name, self._any):
+            if predicates and not match(event, predicates):
+                continue
+            self._call(callback, event, name)
+            calls += 1
+        if self._actions:
+            for predicates, callback in tuple(self._actions.get(event.get("ActionID"), ())):
+                if predicates and not match(event, predicates):
+                    continue
+                self._call(callback, event, name)
+                calls += 1
+        # Rows of the list commands (carrying ActionID) are not counted
+        if not calls and name is not None and event.get("ActionID") is None:
+            self.unhandled[name] += 1
+        self.dispatched += calls
+        return calls
+
 
 if __name__ == "__main__":
-    with open('big.log', 'r') as f:
-    #with open('testing.log', 'r') as f:
-        line_lst = f.readlines()
-        line_str = ''.join( x for x in line_lst if x != '\n' )
-        s1 = line_str[100:300]
-        s2 = line_str[300:800]
-        strm1 = AmiStrm(s1)
-        strm2 = AmiStrm(s2)
-        reg = AmiReg()
-        reg.feed(line_str)
+    # See AmiBench.py for all the benchmark options
+    from AmiBench import bench, report
+    print report(bench())
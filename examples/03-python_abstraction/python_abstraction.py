@@ -14,6 +14,9 @@ class CustomCtl(AmiCtl.AmiCtl):
     Subclass AmiCtl or AmiCmd and override their reactor method
     to do something useful.
     """
+    # Noisy events are dropped before they are parsed
+    parser = AmiReg.AmiReg(deny=['VarSet','RTCPSent','RTCPReceived'])
+
     def __init__(self, *a, **kw):
         super(CustomCtl, self).__init__(*a, **kw)
 
@@ -21,13 +24,12 @@ class CustomCtl(AmiCtl.AmiCtl):
         # Feed data to parser
         self.parser.feed(recv)
         for event in self.parser.events:
-            if event.od.get('Event') not in ['VarSet','RTCPSent','RTCPReceived']:
-                print
-                print "Received new AMI Event:"
-                print type(event)
-                print event.od  # Event as OrderedDict
-                print event.d   # Event as list of dicts
-                print event.t   # Event as list of tuples
+            print
+            print "Received new AMI Event:"
+            print type(event)
+            print event.od  # Event as OrderedDict
+            print event.d   # Event as list of dicts
+            print event.t   # Event as list of tuples
 
 # Connection parameters
 host = "127.0.0.2"